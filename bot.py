@@ -9,13 +9,18 @@
 #   ✅ Postagem automática para TODOS os clientes ativos
 # =================================================================================
 
-import os, html, time, random, logging, threading, secrets, string
+import os, re, html, json, time, heapq, hashlib, random, signal, asyncio, functools, itertools, logging, threading, secrets, string
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse, quote
-import requests, psycopg2
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote, urlencode
+import requests, httpx, psycopg2, psycopg2.pool
+from psycopg2.extras import Json, execute_values
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from telegram.ext import (Application, CommandHandler, MessageHandler,
+from telegram.error import RetryAfter
+from telegram.ext import (Application, BaseUpdateProcessor, CommandHandler, MessageHandler,
                           filters, ContextTypes, CallbackQueryHandler)
 
 # ── Variáveis de ambiente ──────────────────────────────────────────────────
@@ -34,6 +39,7 @@ MP_TOKEN      = os.environ.get("MP_ACCESS_TOKEN", "")  # Mercado Pago Access Tok
 BOT_PUBLIC_URL = os.environ.get("BOT_PUBLIC_URL", "")  # URL pública do bot no Koyeb
 DIAS_SEM_REPETIR = 21
 DIAS_PLANO       = 30
+ENTREGA_PADRAO   = os.environ.get("ENTREGA_PADRAO", "separado")  # separado | botao | legenda
 
 IMG_BASE  = "https://image.tmdb.org/t/p/w500"
 TMDB_BASE = "https://api.themoviedb.org/3"
@@ -52,6 +58,14 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 
 # ── Servidor HTTP (healthcheck + API do painel) ────────────────────────────
 PANEL_PASS = os.environ.get("PANEL_PASS", "")  # Senha do painel web
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")  # vazio = /metrics desligado
+
+# Modo webhook do Telegram: updates chegam por POST neste mesmo servidor (em vez de long polling)
+TG_WEBHOOK        = os.environ.get("TG_WEBHOOK", "") == "1" and bool(BOT_PUBLIC_URL)
+TG_WEBHOOK_PATH   = os.environ.get("TG_WEBHOOK_PATH", "/webhook/telegram")
+# Sem TG_WEBHOOK_SECRET o segredo sai do token: todas as instâncias atrás do balanceador usam o mesmo
+TG_WEBHOOK_SECRET = (os.environ.get("TG_WEBHOOK_SECRET")
+                     or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest())
 
 class AdminHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -63,6 +77,16 @@ class AdminHandler(BaseHTTPRequestHandler):
         if parsed.path == "/admin":
             self._handle_admin(parsed); return
 
+        if parsed.path == "/metrics":
+            # Desligado sem METRICS_TOKEN; o scraper manda "Authorization: Bearer <token>" (ou ?token=)
+            token = self.headers.get("Authorization", "").removeprefix("Bearer ").strip() \
+                    or parse_qs(parsed.query).get("token", [""])[0]
+            if not METRICS_TOKEN or not secrets.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+                self.send_response(404 if not METRICS_TOKEN else 403); self.end_headers(); return
+            body = metricas.exportar().encode()
+            self.send_response(200); self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.end_headers(); self.wfile.write(body); return
+
         self.send_response(404); self.end_headers()
 
     def _cors(self):
@@ -92,23 +116,19 @@ class AdminHandler(BaseHTTPRequestHandler):
 
         try:
             if cmd == "stats":
-                c = db(); cur = c.cursor()
-                cur.execute("SELECT COUNT(*) FROM clientes WHERE ativo=TRUE AND validade > NOW()")
-                ativos = cur.fetchone()[0]
-                cur.execute("SELECT COUNT(*) FROM clientes WHERE ativo=FALSE OR validade <= NOW()")
-                inativos = cur.fetchone()[0]
-                cur.execute("SELECT COUNT(*) FROM tokens WHERE usado=FALSE")
-                tokens_livres = cur.fetchone()[0]
-                cur.close(); c.close()
+                ativos, inativos, tokens_livres = contar_clientes()
                 self._json({"ativos": ativos, "expirados": inativos,
                             "tokens_livres": tokens_livres,
                             "receita": f"{ativos*14.90:.2f}"}); return
 
+            if cmd == "cache":
+                self._json({nome: c.stats() for nome, c in CacheTTL.registro.items()}); return
+
             if cmd == "clientes":
-                c = db(); cur = c.cursor()
-                cur.execute("""SELECT chat_id, ativo, validade, criado_em, modo, site_url, nome_canal
-                    FROM clientes ORDER BY criado_em DESC""")
-                rows = cur.fetchall(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("""SELECT chat_id, ativo, validade, criado_em, modo, site_url, nome_canal
+                        FROM clientes ORDER BY criado_em DESC""")
+                    rows = cur.fetchall()
                 result = []
                 for chat_id, ativo, validade, criado, modo, site_url, nome_canal in rows:
                     dias = (validade - datetime.utcnow()).days if validade else -1
@@ -144,6 +164,12 @@ class AdminHandler(BaseHTTPRequestHandler):
                 ok = set_modo(int(cid), modo)
                 self._json({"ok": ok}); return
 
+            if cmd.startswith("config_entrega:"):
+                _, cid, entrega = cmd.split(":", 2)
+                if entrega not in ENTREGAS:
+                    self._json({"ok": False, "error": f"Entrega inválida. Use: {', '.join(ENTREGAS)}"}); return
+                self._json({"ok": set_entrega(int(cid), entrega)}); return
+
             if cmd.startswith("config_site:"):
                 from urllib.parse import unquote
                 _, cid, url = cmd.split(":", 2)
@@ -168,10 +194,10 @@ class AdminHandler(BaseHTTPRequestHandler):
                 from urllib.parse import unquote
                 _, cid, nome = cmd.split(":", 2)
                 nome = unquote(nome)
-                c = db(); cur = c.cursor()
-                cur.execute("UPDATE clientes SET nome_canal=%s WHERE chat_id=%s",
-                    (None if nome=="remover" else nome, int(cid)))
-                c.commit(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("UPDATE clientes SET nome_canal=%s WHERE chat_id=%s",
+                        (None if nome=="remover" else nome, int(cid)))
+                invalidar_cliente(int(cid))
                 self._json({"ok": True}); return
 
             if cmd.startswith("token_add:"):
@@ -179,28 +205,25 @@ class AdminHandler(BaseHTTPRequestHandler):
                 token_raw = unquote(cmd[len("token_add:"):]).strip().upper()
                 if not token_raw:
                     self._json({"ok": False, "error": "Token vazio"}); return
-                c = db(); cur = c.cursor()
                 try:
-                    cur.execute("INSERT INTO tokens(token,usado) VALUES(%s,FALSE)", (token_raw,))
-                    c.commit(); cur.close(); c.close()
+                    with db() as cur:
+                        cur.execute("INSERT INTO tokens(token,usado) VALUES(%s,FALSE)", (token_raw,))
                     self._json({"ok": True, "token": token_raw}); return
                 except Exception as e:
-                    cur.close(); c.close()
                     self._json({"ok": False, "error": "Token já existe"}); return
 
             if cmd.startswith("token_del:"):
                 token_raw = cmd[len("token_del:"):].strip().upper()
-                c = db(); cur = c.cursor()
-                cur.execute("DELETE FROM tokens WHERE token=%s AND usado=FALSE", (token_raw,))
-                deleted = cur.rowcount
-                c.commit(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("DELETE FROM tokens WHERE token=%s AND usado=FALSE", (token_raw,))
+                    deleted = cur.rowcount
                 self._json({"ok": deleted > 0, "error": "Token já usado ou não encontrado" if not deleted else ""}); return
 
             if cmd.startswith("cliente_del:"):
                 cid = int(cmd.split(":")[1])
-                c = db(); cur = c.cursor()
-                cur.execute("DELETE FROM clientes WHERE chat_id=%s", (cid,))
-                c.commit(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("DELETE FROM clientes WHERE chat_id=%s", (cid,))
+                invalidar_cliente(cid)
                 self._json({"ok": True}); return
 
             if cmd == "propagandas_lista":
@@ -222,38 +245,29 @@ class AdminHandler(BaseHTTPRequestHandler):
 
             if cmd.startswith("propaganda_disparo:"):
                 from urllib.parse import unquote
-                import asyncio
                 texto_raw = cmd[len("propaganda_disparo:"):]
                 texto = unquote(texto_raw) if texto_raw else None
                 canais = []
                 if GRUPO_ID: canais.append(GRUPO_ID)
                 if CANAL_VIP: canais.append(CANAL_VIP)
                 txt = (texto or PROPAGANDAS_FIXAS[0]).format(contato=ADMIN_CONTATO)
-                from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
-                enviados = 0
-                async def _send():
-                    nonlocal enviados
-                    bot = Bot(token=TOKEN)
-                    for cid in canais:
-                        try:
-                            kw2 = {}
-                            if cid == GRUPO_ID and TOPIC_ID:
-                                kw2["message_thread_id"] = TOPIC_ID
-                            await bot.send_message(
-                                chat_id=cid, text=txt, parse_mode="HTML",
-                                reply_markup=InlineKeyboardMarkup([[
-                                    InlineKeyboardButton("💬 Falar com Admin",
-                                        url=f"https://t.me/{ADMIN_CONTATO.lstrip('@')}")
-                                ]]), **kw2)
-                            enviados += 1
-                        except: pass
-                asyncio.run(_send())
-                self._json({"ok": True, "enviados": enviados}); return
+                markup = InlineKeyboardMarkup([[
+                    InlineKeyboardButton("💬 Falar com Admin",
+                        url=f"https://t.me/{ADMIN_CONTATO.lstrip('@')}")
+                ]])
+                def _send(cid):
+                    kw2 = {}
+                    if cid == GRUPO_ID and TOPIC_ID:
+                        kw2["message_thread_id"] = TOPIC_ID
+                    return envios.executar(cid, lambda: _APP.bot.send_message(
+                        chat_id=cid, text=txt, parse_mode="HTML", reply_markup=markup, **kw2), PRIO_BROADCAST)
+                tid = iniciar_tarefa("propaganda_disparo", canais, _send)
+                self._json({"ok": True, "job_id": tid, "total": len(canais)}); return
 
             if cmd == "tokens_lista":
-                c = db(); cur = c.cursor()
-                cur.execute("SELECT token, usado, criado_em FROM tokens ORDER BY criado_em DESC LIMIT 100")
-                rows = cur.fetchall(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("SELECT token, usado, criado_em FROM tokens ORDER BY criado_em DESC LIMIT 100")
+                    rows = cur.fetchall()
                 result = [{"token": r[0], "usado": bool(r[1]),
                            "criado_em": r[2].strftime("%d/%m/%Y %H:%M") if r[2] else ""} for r in rows]
                 self._json({"tokens": result}); return
@@ -261,28 +275,27 @@ class AdminHandler(BaseHTTPRequestHandler):
             if cmd.startswith("broadcast:"):
                 from urllib.parse import unquote
                 msg = unquote(cmd[len("broadcast:"):])
-                c = db(); cur = c.cursor()
-                cur.execute("SELECT chat_id FROM clientes WHERE ativo=TRUE AND validade > NOW()")
-                chats = [r[0] for r in cur.fetchall()]; cur.close(); c.close()
-                enviados = 0
-                import asyncio
-                async def _send_all():
-                    nonlocal enviados
-                    from telegram import Bot
-                    bot = Bot(token=TOKEN)
-                    for cid in chats:
-                        try:
-                            await bot.send_message(chat_id=cid, text=msg)
-                            enviados += 1
-                        except: pass
-                asyncio.run(_send_all())
-                self._json({"ok": True, "enviados": enviados}); return
+                with db() as cur:
+                    cur.execute("SELECT chat_id FROM clientes WHERE ativo=TRUE AND validade > NOW()")
+                    chats = [r[0] for r in cur.fetchall()]
+                tid = iniciar_tarefa("broadcast", chats, lambda cid: envios.executar(
+                    cid, lambda: _APP.bot.send_message(chat_id=cid, text=msg), PRIO_BROADCAST))
+                self._json({"ok": True, "job_id": tid, "total": len(chats)}); return
+
+            if cmd == "job_status" or cmd.startswith("job_status:"):
+                tid = cmd[len("job_status:"):]
+                if not tid:
+                    self._json({"jobs": listar_tarefas()}); return
+                st = status_tarefa(tid)
+                if st: self._json(st)
+                else:  self._json({"error": "Job não encontrado."}, 404)
+                return
 
             if cmd == "historico":
-                c = db(); cur = c.cursor()
-                cur.execute("""SELECT chat_id, token, criado_em, validade
-                    FROM clientes ORDER BY criado_em DESC LIMIT 50""")
-                rows = cur.fetchall(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("""SELECT chat_id, token, criado_em, validade
+                        FROM clientes ORDER BY criado_em DESC LIMIT 50""")
+                    rows = cur.fetchall()
                 result = [{"chat_id": r[0], "token": r[1],
                            "criado_em": r[2].strftime("%d/%m/%Y %H:%M") if r[2] else "",
                            "validade": r[3].strftime("%d/%m/%Y") if r[3] else ""} for r in rows]
@@ -290,10 +303,10 @@ class AdminHandler(BaseHTTPRequestHandler):
 
 
             if cmd == "premios_lista":
-                c = db(); cur = c.cursor()
-                cur.execute("""SELECT id, tipo, nome, conteudo, valor, usado, data_exp, criado_em
-                    FROM premios ORDER BY tipo, usado, id DESC""")
-                rows = cur.fetchall(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("""SELECT id, tipo, nome, conteudo, valor, usado, data_exp, criado_em
+                        FROM premios ORDER BY tipo, usado, id DESC""")
+                    rows = cur.fetchall()
                 result = [{"id":r[0],"tipo":r[1],"nome":r[2],"conteudo":r[3],
                            "valor":float(r[4]),"usado":bool(r[5]),"data_exp":r[6],
                            "criado_em":r[7].strftime("%d/%m/%Y") if r[7] else ""} for r in rows]
@@ -307,34 +320,37 @@ class AdminHandler(BaseHTTPRequestHandler):
                 import json
                 raw = unquote(cmd[len("premio_add:"):])
                 data = json.loads(raw)
-                c = db(); cur = c.cursor()
-                cur.execute("INSERT INTO premios(tipo,nome,conteudo,valor,data_exp) VALUES(%s,%s,%s,%s,%s)",
-                    (data["tipo"], data["nome"], data["conteudo"], float(data["valor"]), data.get("data_exp")))
-                c.commit(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("INSERT INTO premios(tipo,nome,conteudo,valor,data_exp) VALUES(%s,%s,%s,%s,%s)",
+                        (data["tipo"], data["nome"], data["conteudo"], float(data["valor"]), data.get("data_exp")))
+                invalidar_estoque()
                 self._json({"ok": True}); return
 
             if cmd.startswith("premio_del:"):
                 pid = int(cmd.split(":")[1])
-                c = db(); cur = c.cursor()
-                cur.execute("DELETE FROM premios WHERE id=%s AND usado=FALSE", (pid,))
-                ok = cur.rowcount > 0
-                c.commit(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("DELETE FROM premios WHERE id=%s AND usado=FALSE", (pid,))
+                    ok = cur.rowcount > 0
+                invalidar_estoque()
                 self._json({"ok": ok}); return
 
             if cmd == "resgates_lista":
-                c = db(); cur = c.cursor()
-                cur.execute("""SELECT r.user_id, p.tipo, p.nome, r.valor, r.criado_em
-                    FROM resgates r JOIN premios p ON r.premio_id=p.id
-                    ORDER BY r.criado_em DESC LIMIT 50""")
-                rows = cur.fetchall(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("""SELECT r.user_id, p.tipo, p.nome, r.valor, r.criado_em
+                        FROM resgates r JOIN premios p ON r.premio_id=p.id
+                        ORDER BY r.criado_em DESC LIMIT 50""")
+                    rows = cur.fetchall()
                 result = [{"user_id":r[0],"tipo":r[1],"nome":r[2],"valor":float(r[3]),
                            "criado_em":r[4].strftime("%d/%m/%Y %H:%M") if r[4] else ""} for r in rows]
                 self._json({"resgates": result}); return
 
+            if cmd == "conciliacao":
+                self._json(dict(_conciliacao)); return
+
             if cmd == "creditos_lista":
-                c = db(); cur = c.cursor()
-                cur.execute("SELECT user_id, saldo, atualizado FROM creditos ORDER BY saldo DESC LIMIT 50")
-                rows = cur.fetchall(); cur.close(); c.close()
+                with db() as cur:
+                    cur.execute("SELECT user_id, saldo, atualizado FROM creditos ORDER BY saldo DESC LIMIT 50")
+                    rows = cur.fetchall()
                 result = [{"user_id":r[0],"saldo":float(r[1]),
                            "atualizado":r[2].strftime("%d/%m/%Y") if r[2] else ""} for r in rows]
                 self._json({"creditos": result}); return
@@ -351,10 +367,25 @@ class AdminHandler(BaseHTTPRequestHandler):
             self._json({"error": str(e)}, 500)
 
 
+    def _update_telegram(self):
+        """Update do Telegram (modo webhook): confere o secret token e entrega à update_queue da Application."""
+        segredo = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+        if not secrets.compare_digest(segredo, TG_WEBHOOK_SECRET.encode()):
+            self.send_response(403); self.end_headers(); return
+        dados = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        try:
+            if _APP is None: raise RuntimeError("Bot ainda não está rodando")
+            agendar_no_loop_do_bot(_APP.update_queue.put(Update.de_json(dados, _APP.bot)))
+        except RuntimeError:
+            self.send_response(503); self.end_headers(); return   # o Telegram reenvia
+        self.send_response(200); self.end_headers()
+
     def do_POST(self):
-        """Webhook do Mercado Pago."""
+        """Webhook do Mercado Pago (e do Telegram, no modo webhook)."""
         try:
             parsed = urlparse(self.path)
+            if TG_WEBHOOK and parsed.path == TG_WEBHOOK_PATH:
+                self._update_telegram(); return
             if parsed.path == "/webhook/mp":
                 length = int(self.headers.get("Content-Length", 0))
                 body = self.rfile.read(length)
@@ -363,40 +394,11 @@ class AdminHandler(BaseHTTPRequestHandler):
                 if data.get("type") == "payment":
                     payment_id = str(data.get("data", {}).get("id", ""))
                     if payment_id:
-                        status = verificar_pagamento_mp(payment_id)
-                        if status == "approved":
-                            c = db(); cur = c.cursor()
-                            cur.execute("SELECT user_id, valor, status FROM pagamentos WHERE payment_id=%s", (payment_id,))
-                            row = cur.fetchone()
-                            if row and row[2] == "pending":
-                                user_id, valor = row[0], float(row[1])
-                                cur.execute("UPDATE pagamentos SET status='approved' WHERE payment_id=%s", (payment_id,))
-                                c.commit()
-                                add_saldo(user_id, valor)
-                                cur.close(); c.close()
-                                # Notifica o usuário
-                                import asyncio
-                                async def _notify():
-                                    from telegram import Bot
-                                    bot = Bot(token=TOKEN)
-                                    saldo = get_saldo(user_id)
-                                    await bot.send_message(
-                                        chat_id=user_id,
-                                        text=f"✅ <b>Pagamento confirmado!</b>\n\n"
-                                             f"💰 R$ {valor:.2f} adicionado ao seu saldo\n"
-                                             f"🏦 Saldo atual: <b>R$ {saldo:.2f}</b>\n\n"
-                                             f"Use /credito para resgatar seus prêmios!",
-                                        parse_mode="HTML"
-                                    )
-                                    # Avisa admin também
-                                    if ADMIN_ID:
-                                        await bot.send_message(
-                                            chat_id=ADMIN_ID,
-                                            text=f"💸 Pagamento recebido!\nUser: {user_id}\nValor: R$ {valor:.2f}",
-                                        )
-                                asyncio.run(_notify())
-                            else:
-                                if row: cur.close(); c.close()
+                        # Responde na hora: verificação, crédito e aviso ficam com os workers do bot
+                        try:
+                            enfileirar_pagamento(payment_id)
+                        except RuntimeError:
+                            self.send_response(503); self.end_headers(); return   # MP reenvia depois
                 self.send_response(200)
                 self.end_headers()
                 self.wfile.write(b"OK")
@@ -410,106 +412,452 @@ class AdminHandler(BaseHTTPRequestHandler):
     def log_message(self, *a, **k): pass
 
 def start_health():
-    HTTPServer(("0.0.0.0", int(os.environ.get("PORT","8000"))), AdminHandler).serve_forever()
+    # Uma thread por requisição: um /admin demorado não trava healthcheck nem webhook
+    srv = ThreadingHTTPServer(("0.0.0.0", int(os.environ.get("PORT","8000"))), AdminHandler)
+    srv.daemon_threads = True
+    srv.serve_forever()
+
+
+# ── Banco (pool de conexões) ───────────────────────────────────────────────
+DB_POOL_MIN   = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX   = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_ESPERA = 15   # segundos esperando uma conexão livre antes de desistir
+DB_PING_APOS   = 30   # conexão ociosa há mais que isso é testada com SELECT 1
+
+_pool       = None
+_pool_lock  = threading.Lock()
+_pool_vagas = threading.BoundedSemaphore(DB_POOL_MAX)
+_ultimo_uso = {}      # id(conexão) → time.monotonic() da última devolução
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                r = urlparse(DATABASE_URL)
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    dbname=r.path[1:], user=r.username, password=r.password,
+                    host=r.hostname, port=r.port, connect_timeout=10,
+                    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+                )
+    return _pool
+
+def _conexao_ok(c):
+    """Health check: descarta conexões fechadas e pinga as que ficaram ociosas."""
+    if c.closed: return False
+    ultimo = _ultimo_uso.get(id(c))
+    if ultimo is None or time.monotonic() - ultimo < DB_PING_APOS: return True
+    try:
+        with c.cursor() as cur: cur.execute("SELECT 1")
+        c.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
+def _descartar(pool, c):
+    _ultimo_uso.pop(id(c), None)
+    try: pool.putconn(c, close=True)
+    except Exception: pass
 
-# ── Banco ──────────────────────────────────────────────────────────────────
+@contextmanager
 def db():
-    r = urlparse(DATABASE_URL)
-    return psycopg2.connect(
-        dbname=r.path[1:], user=r.username, password=r.password,
-        host=r.hostname, port=r.port, connect_timeout=10
-    )
+    """Empresta uma conexão do pool e entrega um cursor.
+
+    Faz commit ao sair sem erro e rollback se houver exceção. Conexões
+    quebradas são descartadas e o pool abre uma nova no próximo uso.
+    """
+    inicio = time.monotonic()
+    if not _pool_vagas.acquire(timeout=DB_POOL_ESPERA):
+        metricas.contar("streamflix_db_erros_total", erro="pool_esgotado")
+        raise psycopg2.pool.PoolError("Pool de conexões esgotado")
+    pool = c = None
+    emprestada = None   # momento em que a conexão ficou disponível
+    try:
+        pool = _get_pool()
+        c = pool.getconn()
+        while not _conexao_ok(c):
+            _descartar(pool, c)
+            c = pool.getconn()
+        emprestada = time.monotonic()
+        metricas.observar("streamflix_db_espera_segundos", emprestada - inicio)
+        with c.cursor() as cur:
+            yield cur
+        c.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        metricas.contar("streamflix_db_erros_total", erro="conexao")
+        if c is not None: _descartar(pool, c); c = None
+        raise
+    except BaseException:
+        metricas.contar("streamflix_db_erros_total", erro="consulta")
+        if c is not None and not c.closed:
+            try: c.rollback()
+            except psycopg2.Error: _descartar(pool, c); c = None
+        raise
+    finally:
+        if c is not None:
+            if c.closed: _descartar(pool, c)
+            else:
+                _ultimo_uso[id(c)] = time.monotonic()
+                pool.putconn(c)
+        _pool_vagas.release()
+        if emprestada is not None:
+            metricas.observar("streamflix_db_segundos", time.monotonic() - emprestada)
+
+# Os helpers do banco são síncronos; no loop do bot eles rodam nestas threads,
+# no máximo uma por conexão do pool, para uma consulta lenta não travar os outros chats
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+async def no_banco(fn, *args, **kwargs):
+    """Executa um helper síncrono do banco fora do loop e devolve o resultado."""
+    with metricas.cronometro("streamflix_db_helper_segundos", helper=getattr(fn, "__name__", "?")):
+        return await asyncio.get_running_loop().run_in_executor(
+            _db_executor, functools.partial(fn, *args, **kwargs))
+
+# ── Cache em memória ───────────────────────────────────────────────────────
+class CacheTTL:
+    """Cache LRU em memória com expiração por item. Seguro entre threads."""
+
+    registro = {}   # nome → instância, para estatísticas
+
+    def __init__(self, ttl, maxsize=1024, nome=None):
+        self.ttl     = ttl
+        self.maxsize = maxsize
+        self.hits    = 0
+        self.misses  = 0
+        self._dados  = OrderedDict()   # chave → (expira_em, valor)
+        self._lock   = threading.Lock()
+        if nome: CacheTTL.registro[nome] = self
+
+    def get(self, chave, padrao=None):
+        with self._lock:
+            item = self._dados.get(chave)
+            if item is None or item[0] < time.monotonic():
+                if item is not None: del self._dados[chave]
+                self.misses += 1
+                return padrao
+            self._dados.move_to_end(chave)
+            self.hits += 1
+            return item[1]
+
+    def set(self, chave, valor, ttl=None):
+        with self._lock:
+            self._dados[chave] = (time.monotonic() + (ttl or self.ttl), valor)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.maxsize:
+                self._dados.popitem(last=False)
+
+    def invalidar(self, chave=None):
+        """Remove uma chave, ou tudo se nenhuma for passada."""
+        with self._lock:
+            if chave is None: self._dados.clear()
+            else: self._dados.pop(chave, None)
+
+    def exportar(self):
+        """Entradas ainda válidas como (chave, segundos_restantes, valor)."""
+        agora = time.monotonic()
+        with self._lock:
+            return [(k, exp - agora, v) for k, (exp, v) in self._dados.items() if exp > agora]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"itens": len(self._dados), "max": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+    def __len__(self):
+        return len(self._dados)
+
+# ── Métricas (/metrics no formato texto do Prometheus) ─────────────────────
+BALDES_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Metricas:
+    """Contadores e histogramas de latência em memória. Seguro entre threads."""
+
+    def __init__(self, baldes=BALDES_SEGUNDOS):
+        self.baldes       = baldes
+        self._contadores  = {}   # nome → {rótulos: valor}
+        self._histogramas = {}   # nome → {rótulos: [contagem por balde…, soma, total]}
+        self._lock        = threading.Lock()
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self._lock:
+            serie = self._contadores.setdefault(nome, {})
+            serie[chave] = serie.get(chave, 0) + valor
+
+    def observar(self, nome, segundos, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self._lock:
+            h = self._histogramas.setdefault(nome, {}).get(chave)
+            if h is None:
+                h = self._histogramas[nome][chave] = [0] * len(self.baldes) + [0.0, 0]
+            for i, limite in enumerate(self.baldes):
+                if segundos <= limite: h[i] += 1
+            h[-2] += segundos; h[-1] += 1
+
+    @contextmanager
+    def cronometro(self, nome, **rotulos):
+        inicio = time.monotonic()
+        try: yield
+        finally: self.observar(nome, time.monotonic() - inicio, **rotulos)
+
+    @staticmethod
+    def _rotulos(chave, extra=()):
+        pares = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                 for k, v in (*chave, *extra)]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pares) + "}" if pares else ""
+
+    def exportar(self):
+        with self._lock:
+            contadores  = {n: dict(s) for n, s in self._contadores.items()}
+            histogramas = {n: {k: list(h) for k, h in s.items()} for n, s in self._histogramas.items()}
+        linhas = []
+        for nome, serie in sorted(contadores.items()):
+            linhas.append(f"# TYPE {nome} counter")
+            linhas += [f"{nome}{self._rotulos(k)} {v}" for k, v in serie.items()]
+        for nome, serie in sorted(histogramas.items()):
+            linhas.append(f"# TYPE {nome} histogram")
+            for k, h in serie.items():
+                linhas += [f"{nome}_bucket{self._rotulos(k, [('le', limite)])} {h[i]}"
+                           for i, limite in enumerate(self.baldes)]
+                linhas += [f"{nome}_bucket{self._rotulos(k, [('le', '+Inf')])} {h[-1]}",
+                           f"{nome}_sum{self._rotulos(k)} {h[-2]:.6f}",
+                           f"{nome}_count{self._rotulos(k)} {h[-1]}"]
+        # Caches nomeados (CacheTTL.registro)
+        caches = CacheTTL.registro.items()
+        for nome, campo, tipo in (("streamflix_cache_hits_total", "hits", "counter"),
+                                  ("streamflix_cache_misses_total", "misses", "counter"),
+                                  ("streamflix_cache_itens", "itens", "gauge"),
+                                  ("streamflix_cache_hit_rate", "hit_rate", "gauge")):
+            linhas.append(f"# TYPE {nome} {tipo}")
+            linhas += [f"{nome}{self._rotulos([('cache', c)])} {cache.stats()[campo]}" for c, cache in caches]
+        return "\n".join(linhas) + "\n"
+
+metricas = Metricas()
+
+def medir_job(fn):
+    """Duração (e falhas) de um job do JobQueue em streamflix_job_segundos{job=…}."""
+    @functools.wraps(fn)
+    async def medido(*args, **kwargs):
+        with metricas.cronometro("streamflix_job_segundos", job=fn.__name__):
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                metricas.contar("streamflix_job_falhas_total", job=fn.__name__); raise
+    return medido
 
 def setup_db():
     try:
-        c = db(); cur = c.cursor()
-        # Clientes (multi-tenant)
-        cur.execute("""CREATE TABLE IF NOT EXISTS clientes (
-            chat_id    BIGINT PRIMARY KEY,
-            topic_id   BIGINT DEFAULT 0,
-            token      TEXT,
-            ativo      BOOLEAN DEFAULT TRUE,
-            validade   TIMESTAMP,
-            aviso_3d   BOOLEAN DEFAULT FALSE,
-            aviso_venc BOOLEAN DEFAULT FALSE,
-            criado_em  TIMESTAMP DEFAULT NOW(),
-            modo       TEXT DEFAULT 'completo',
-            site_url   TEXT DEFAULT NULL
-        );""")
-        # Migrações de colunas novas
-        try:
-            cur.execute("ALTER TABLE clientes ADD COLUMN IF NOT EXISTS modo TEXT DEFAULT 'completo'")
-            cur.execute("ALTER TABLE clientes ADD COLUMN IF NOT EXISTS site_url TEXT DEFAULT NULL")
-            cur.execute("ALTER TABLE clientes ADD COLUMN IF NOT EXISTS nome_canal TEXT DEFAULT NULL")
-            cur.execute("ALTER TABLE tokens ADD COLUMN IF NOT EXISTS criado_em TIMESTAMP DEFAULT NOW()")
-            c.commit()
-        except: pass
-        # Propagandas agendadas
-        cur.execute("""CREATE TABLE IF NOT EXISTS propagandas (
-            id        SERIAL PRIMARY KEY,
-            texto     TEXT NOT NULL,
-            ativo     BOOLEAN DEFAULT TRUE,
-            criado_em TIMESTAMP DEFAULT NOW()
-        );""")
-        # Controle de rotação de propagandas
-        cur.execute("""CREATE TABLE IF NOT EXISTS propa_state (
-            id        INTEGER PRIMARY KEY DEFAULT 1,
-            ultimo_idx INTEGER DEFAULT 0
-        );""")
-        cur.execute("INSERT INTO propa_state(id,ultimo_idx) VALUES(1,0) ON CONFLICT DO NOTHING")
-        # Tokens gerados pelo admin
-        cur.execute("""CREATE TABLE IF NOT EXISTS tokens (
-            token     TEXT PRIMARY KEY,
-            usado     BOOLEAN DEFAULT FALSE,
-            criado_em TIMESTAMP DEFAULT NOW()
-        );""")
-        # Itens enviados por cliente (para não repetir)
-        cur.execute("""CREATE TABLE IF NOT EXISTS sent_items (
+        with db() as cur:
+            # Clientes (multi-tenant)
+            cur.execute("""CREATE TABLE IF NOT EXISTS clientes (
+                chat_id    BIGINT PRIMARY KEY,
+                topic_id   BIGINT DEFAULT 0,
+                token      TEXT,
+                ativo      BOOLEAN DEFAULT TRUE,
+                validade   TIMESTAMP,
+                aviso_3d   BOOLEAN DEFAULT FALSE,
+                aviso_venc BOOLEAN DEFAULT FALSE,
+                criado_em  TIMESTAMP DEFAULT NOW(),
+                modo       TEXT DEFAULT 'completo',
+                site_url   TEXT DEFAULT NULL
+            );""")
+            # Migrações de colunas novas
+            try:
+                cur.execute("ALTER TABLE clientes ADD COLUMN IF NOT EXISTS modo TEXT DEFAULT 'completo'")
+                cur.execute("ALTER TABLE clientes ADD COLUMN IF NOT EXISTS site_url TEXT DEFAULT NULL")
+                cur.execute("ALTER TABLE clientes ADD COLUMN IF NOT EXISTS nome_canal TEXT DEFAULT NULL")
+                cur.execute("ALTER TABLE clientes ADD COLUMN IF NOT EXISTS entrega TEXT DEFAULT NULL")
+                cur.execute("ALTER TABLE tokens ADD COLUMN IF NOT EXISTS criado_em TIMESTAMP DEFAULT NOW()")
+                cur.connection.commit()
+            except: pass
+            # Propagandas agendadas
+            cur.execute("""CREATE TABLE IF NOT EXISTS propagandas (
+                id        SERIAL PRIMARY KEY,
+                texto     TEXT NOT NULL,
+                ativo     BOOLEAN DEFAULT TRUE,
+                criado_em TIMESTAMP DEFAULT NOW()
+            );""")
+            # Controle de rotação de propagandas
+            cur.execute("""CREATE TABLE IF NOT EXISTS propa_state (
+                id        INTEGER PRIMARY KEY DEFAULT 1,
+                ultimo_idx INTEGER DEFAULT 0
+            );""")
+            cur.execute("INSERT INTO propa_state(id,ultimo_idx) VALUES(1,0) ON CONFLICT DO NOTHING")
+            # Tokens gerados pelo admin
+            cur.execute("""CREATE TABLE IF NOT EXISTS tokens (
+                token     TEXT PRIMARY KEY,
+                usado     BOOLEAN DEFAULT FALSE,
+                criado_em TIMESTAMP DEFAULT NOW()
+            );""")
+            # Itens enviados por cliente (para não repetir)
+            cur.execute("""CREATE TABLE IF NOT EXISTS sent_items (
+                chat_id   BIGINT NOT NULL,
+                item_id   BIGINT NOT NULL,
+                item_type TEXT NOT NULL,
+                sent_at   TIMESTAMP NOT NULL,
+                PRIMARY KEY (chat_id, item_id, item_type)
+            );""")
+            _preparar_sent_items(cur)
+            cur.execute("""CREATE INDEX IF NOT EXISTS idx_sent_items_chat_tipo_data
+                ON sent_items(chat_id, item_type, sent_at)""")
+
+            # Sistema de créditos
+            cur.execute("""CREATE TABLE IF NOT EXISTS creditos (
+                user_id    BIGINT PRIMARY KEY,
+                saldo      NUMERIC(10,2) DEFAULT 0,
+                atualizado TIMESTAMP DEFAULT NOW()
+            );""")
+            # Prêmios cadastrados pelo admin
+            cur.execute("""CREATE TABLE IF NOT EXISTS premios (
+                id         SERIAL PRIMARY KEY,
+                tipo       TEXT NOT NULL,
+                nome       TEXT NOT NULL,
+                conteudo   TEXT NOT NULL,
+                valor      NUMERIC(10,2) NOT NULL,
+                usado      BOOLEAN DEFAULT FALSE,
+                data_exp   TEXT DEFAULT NULL,
+                criado_em  TIMESTAMP DEFAULT NOW()
+            );""")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_premios_livres ON premios(tipo, id) WHERE usado=FALSE")
+            # Resgates realizados
+            cur.execute("""CREATE TABLE IF NOT EXISTS resgates (
+                id         SERIAL PRIMARY KEY,
+                user_id    BIGINT NOT NULL,
+                premio_id  INTEGER NOT NULL,
+                valor      NUMERIC(10,2) NOT NULL,
+                criado_em  TIMESTAMP DEFAULT NOW()
+            );""")
+            # Pagamentos PIX pendentes
+            cur.execute("""CREATE TABLE IF NOT EXISTS pagamentos (
+                payment_id TEXT PRIMARY KEY,
+                user_id    BIGINT NOT NULL,
+                valor      NUMERIC(10,2) NOT NULL,
+                status     TEXT DEFAULT 'pending',
+                criado_em  TIMESTAMP DEFAULT NOW()
+            );""")
+            cur.execute("ALTER TABLE pagamentos ADD COLUMN IF NOT EXISTS aprovado_em TIMESTAMP")
+            cur.execute("""CREATE INDEX IF NOT EXISTS idx_pagamentos_pendentes
+                ON pagamentos(criado_em, payment_id) WHERE status='pending'""")
+            # Outbox: entregas agendadas planejadas (retomadas após reinício)
+            cur.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id         BIGSERIAL PRIMARY KEY,
+                chave      TEXT UNIQUE NOT NULL,
+                lote       TEXT NOT NULL,
+                chat_id    BIGINT NOT NULL,
+                payload    JSONB NOT NULL,
+                status     TEXT DEFAULT 'pending',
+                tentativas INTEGER DEFAULT 0,
+                criado_em  TIMESTAMP DEFAULT NOW(),
+                atualizado TIMESTAMP DEFAULT NOW()
+            );""")
+            cur.execute("""CREATE INDEX IF NOT EXISTS idx_outbox_abertos ON outbox(id)
+                WHERE status IN ('pending','sending')""")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_lote ON outbox(lote)")
+        logging.info("✅ Banco pronto (v8 SaaS)")
+    except Exception as e:
+        logging.error(f"Banco: {e}")
+
+
+# ── Retenção e particionamento de sent_items ──────────────────────────────
+# Com SENT_ITEMS_PARTICIONADO=1 a tabela é particionada por semana em sent_at:
+# a retenção vira DROP de partições antigas em vez de DELETE linha a linha.
+SENT_ITEMS_PARTICIONADO = os.environ.get("SENT_ITEMS_PARTICIONADO", "") == "1"
+SENT_PARTICOES_A_FRENTE = 2      # semanas futuras já criadas
+LIMPEZA_LOTE            = 5000   # linhas por DELETE na retenção sem partições
+OUTBOX_RETENCAO_DIAS    = 7
+
+_sent_particionado = False       # estado real da tabela, lido no setup_db
+
+def _semana(d):
+    d = datetime(d.year, d.month, d.day)
+    return d - timedelta(days=d.weekday())
+
+def _garantir_particoes(cur):
+    """Cria as partições semanais que faltam. A partição DEFAULT segura as gravações se o
+    job_limpeza ficar parado; ao criar uma semana, as linhas dela saem da DEFAULT."""
+    cur.execute("CREATE TABLE IF NOT EXISTS sent_items_default PARTITION OF sent_items DEFAULT")
+    semana = _semana(datetime.utcnow() - timedelta(days=DIAS_SEM_REPETIR))
+    fim    = _semana(datetime.utcnow()) + timedelta(weeks=SENT_PARTICOES_A_FRENTE)
+    while semana <= fim:
+        nome, ate = f"sent_items_p{semana:%Y%m%d}", semana + timedelta(weeks=1)
+        cur.execute("SELECT to_regclass(%s) IS NULL", (nome,))
+        if cur.fetchone()[0]:
+            # Postgres recusa a nova partição se a DEFAULT tiver linhas do intervalo: move antes
+            cur.execute("""CREATE TEMP TABLE sent_items_mover ON COMMIT DROP AS
+                SELECT * FROM sent_items_default WHERE sent_at >= %s AND sent_at < %s""", (semana, ate))
+            cur.execute("DELETE FROM sent_items_default WHERE sent_at >= %s AND sent_at < %s", (semana, ate))
+            cur.execute(f"""CREATE TABLE {nome} PARTITION OF sent_items FOR VALUES FROM (%s) TO (%s)""",
+                        (f"{semana:%Y-%m-%d}", f"{ate:%Y-%m-%d}"))
+            cur.execute("INSERT INTO sent_items SELECT * FROM sent_items_mover")
+            cur.execute("DROP TABLE sent_items_mover")
+        semana = ate
+
+def _preparar_sent_items(cur):
+    """Detecta se sent_items é particionada; com SENT_ITEMS_PARTICIONADO=1 converte (uma vez).
+
+    Quando particionada, garante as partições das próximas semanas.
+    """
+    global _sent_particionado
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('sent_items')")
+    _sent_particionado = cur.fetchone()[0] == "p"
+    if SENT_ITEMS_PARTICIONADO and not _sent_particionado:
+        logging.info("Migrando sent_items para tabela particionada por semana…")
+        cur.execute("ALTER TABLE sent_items RENAME TO sent_items_legado")
+        cur.execute("DROP INDEX IF EXISTS idx_sent_items_chat_tipo_data")
+        # Em tabela particionada a PK precisa conter a chave de partição
+        cur.execute("""CREATE TABLE sent_items (
             chat_id   BIGINT NOT NULL,
             item_id   BIGINT NOT NULL,
             item_type TEXT NOT NULL,
             sent_at   TIMESTAMP NOT NULL,
-            PRIMARY KEY (chat_id, item_id, item_type)
-        );""")
-
-        # Sistema de créditos
-        cur.execute("""CREATE TABLE IF NOT EXISTS creditos (
-            user_id    BIGINT PRIMARY KEY,
-            saldo      NUMERIC(10,2) DEFAULT 0,
-            atualizado TIMESTAMP DEFAULT NOW()
-        );""")
-        # Prêmios cadastrados pelo admin
-        cur.execute("""CREATE TABLE IF NOT EXISTS premios (
-            id         SERIAL PRIMARY KEY,
-            tipo       TEXT NOT NULL,
-            nome       TEXT NOT NULL,
-            conteudo   TEXT NOT NULL,
-            valor      NUMERIC(10,2) NOT NULL,
-            usado      BOOLEAN DEFAULT FALSE,
-            data_exp   TEXT DEFAULT NULL,
-            criado_em  TIMESTAMP DEFAULT NOW()
-        );""")
-        # Resgates realizados
-        cur.execute("""CREATE TABLE IF NOT EXISTS resgates (
-            id         SERIAL PRIMARY KEY,
-            user_id    BIGINT NOT NULL,
-            premio_id  INTEGER NOT NULL,
-            valor      NUMERIC(10,2) NOT NULL,
-            criado_em  TIMESTAMP DEFAULT NOW()
-        );""")
-        # Pagamentos PIX pendentes
-        cur.execute("""CREATE TABLE IF NOT EXISTS pagamentos (
-            payment_id TEXT PRIMARY KEY,
-            user_id    BIGINT NOT NULL,
-            valor      NUMERIC(10,2) NOT NULL,
-            status     TEXT DEFAULT 'pending',
-            criado_em  TIMESTAMP DEFAULT NOW()
-        );""")
-        c.commit(); cur.close(); c.close()
-        logging.info("✅ Banco pronto (v8 SaaS)")
-    except Exception as e:
-        logging.error(f"Banco: {e}")
+            PRIMARY KEY (chat_id, item_id, item_type, sent_at)
+        ) PARTITION BY RANGE (sent_at);""")
+        _garantir_particoes(cur)
+        cur.execute("""INSERT INTO sent_items SELECT chat_id, item_id, item_type, sent_at
+            FROM sent_items_legado WHERE sent_at >= %s""", (_semana(datetime.utcnow() - timedelta(days=DIAS_SEM_REPETIR)),))
+        cur.execute("DROP TABLE sent_items_legado")
+        _sent_particionado = True
+    elif _sent_particionado:
+        _garantir_particoes(cur)
+
+def limpar_sent_items():
+    """Apaga registros mais velhos que DIAS_SEM_REPETIR (e outbox antiga). Retorna linhas/partições removidas."""
+    corte = datetime.utcnow() - timedelta(days=DIAS_SEM_REPETIR)
+    removidos = 0
+    if _sent_particionado:
+        with db() as cur:
+            _garantir_particoes(cur)
+            cur.execute("""SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'sent_items'::regclass""")
+            for (nome,) in cur.fetchall():
+                try: inicio = datetime.strptime(nome[-8:], "%Y%m%d")
+                except ValueError: continue
+                if inicio + timedelta(weeks=1) <= corte:
+                    cur.execute(f"DROP TABLE {nome}"); removidos += 1
+            cur.execute("DELETE FROM sent_items_default WHERE sent_at < %s", (corte,))
+    else:
+        # Em lotes, para não segurar locks nem inflar o WAL numa transação só
+        while True:
+            with db() as cur:
+                cur.execute("""DELETE FROM sent_items WHERE ctid IN (
+                    SELECT ctid FROM sent_items WHERE sent_at < %s LIMIT %s)""", (corte, LIMPEZA_LOTE))
+                n = cur.rowcount
+            removidos += n
+            if n < LIMPEZA_LOTE: break
+    with db() as cur:
+        cur.execute("""DELETE FROM outbox WHERE criado_em < NOW() - %s * INTERVAL '1 day'
+            AND status NOT IN ('pending','sending')""", (OUTBOX_RETENCAO_DIAS,))
+    return removidos
+
+@medir_job
+async def job_limpeza(context: ContextTypes.DEFAULT_TYPE):
+    """Roda 1x ao dia: retenção de sent_items e outbox."""
+    try:
+        removidos = await no_banco(limpar_sent_items)
+        logging.info(f"Limpeza: {removidos} {'partições' if _sent_particionado else 'linhas'} de sent_items removidas")
+    except Exception as e: logging.error(f"Limpeza: {e}")
 
 
 # ── Propagandas ────────────────────────────────────────────────────────────
@@ -523,64 +871,56 @@ PROPAGANDAS_FIXAS = [
 
 def get_propagandas():
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT texto FROM propagandas WHERE ativo=TRUE ORDER BY id")
-        rows = [r[0] for r in cur.fetchall()]; cur.close(); c.close()
+        with db() as cur:
+            cur.execute("SELECT texto FROM propagandas WHERE ativo=TRUE ORDER BY id")
+            rows = [r[0] for r in cur.fetchall()]
         return rows
     except: return []
 
 def get_proximo_idx():
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT ultimo_idx FROM propa_state WHERE id=1")
-        r = cur.fetchone()
-        idx = (r[0] + 1) if r else 0
-        cur.execute("UPDATE propa_state SET ultimo_idx=%s WHERE id=1", (idx,))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("SELECT ultimo_idx FROM propa_state WHERE id=1")
+            r = cur.fetchone()
+            idx = (r[0] + 1) if r else 0
+            cur.execute("UPDATE propa_state SET ultimo_idx=%s WHERE id=1", (idx,))
         return idx
     except: return 0
 
 def add_propaganda(texto):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("INSERT INTO propagandas(texto) VALUES(%s)", (texto,))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("INSERT INTO propagandas(texto) VALUES(%s)", (texto,))
         return True
     except: return False
 
 def listar_propagandas():
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT id, texto, ativo, criado_em FROM propagandas ORDER BY id DESC")
-        rows = cur.fetchall(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("SELECT id, texto, ativo, criado_em FROM propagandas ORDER BY id DESC")
+            rows = cur.fetchall()
         return rows
     except: return []
 
 def deletar_propaganda(pid):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("DELETE FROM propagandas WHERE id=%s", (pid,))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("DELETE FROM propagandas WHERE id=%s", (pid,))
         return True
     except: return False
 
 
 # ── Handlers de Crédito ────────────────────────────────────────────────────
-async def cmd_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+NOMES_TIPO = {
+    "xtream": "Conta Xtream IPTV",
+    "vip": "Código VIP StreamFlix",
+}
+EMOJI_TIPO = {"xtream": "📺", "vip": "🎟️"}
+
+def menu_credito(user_id):
+    """Texto e teclado do menu de créditos (usado pelo /credito e pelo botão voltar)."""
     saldo = get_saldo(user_id)
-    premios = get_premios_disponiveis()
-
-    # Tipos disponíveis
-    NOMES_TIPO = {
-        "xtream": "Conta Xtream IPTV",
-        "vip": "Código VIP StreamFlix",
-    }
-    tipos = {}
-    for p in premios:
-        if p["tipo"] not in tipos:
-            tipos[p["tipo"]] = {"qtd": 0, "valor": p["valor"]}
-        tipos[p["tipo"]]["qtd"] += 1
+    tipos = estoque_premios()
 
     texto = (
         f"💰 <b>Seus Créditos StreamFlix</b>\n\n"
@@ -590,7 +930,7 @@ async def cmd_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if tipos:
         texto += "🎁 <b>Prêmios disponíveis:</b>\n"
         for tipo, info in tipos.items():
-            emoji = "📺" if tipo == "xtream" else "🎟️" if tipo == "vip" else "🎁"
+            emoji = EMOJI_TIPO.get(tipo, "🎁")
             nome_tipo = NOMES_TIPO.get(tipo, tipo.upper())
             texto += f"{emoji} {info['qtd']}x {nome_tipo} — R$ {info['valor']:.2f} cada\n"
         texto += "\nEscolha uma opção abaixo:"
@@ -609,14 +949,15 @@ async def cmd_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ])
     # Botões de resgate
     for tipo, info in tipos.items():
-        emoji = "📺" if tipo == "xtream" else "🎟️" if tipo == "vip" else "🎁"
         botoes.append([InlineKeyboardButton(
-            f"{emoji} {NOMES_TIPO.get(tipo, tipo.upper())} — R$ {info['valor']:.2f}",  # botão resgate
+            f"{EMOJI_TIPO.get(tipo, '🎁')} {NOMES_TIPO.get(tipo, tipo.upper())} — R$ {info['valor']:.2f}",  # botão resgate
             callback_data=f"resgatar:{tipo}"
         )])
+    return texto, InlineKeyboardMarkup(botoes)
 
-    await update.message.reply_text(texto, parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(botoes))
+async def cmd_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    texto, markup = await no_banco(menu_credito, update.effective_user.id)
+    await update.message.reply_text(texto, parse_mode="HTML", reply_markup=markup)
 
 async def callback_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -626,12 +967,11 @@ async def callback_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("pix:"):
         valor = float(data.split(":")[1])
-        saldo_atual = get_saldo(user_id)
         await q.edit_message_text(
             f"⏳ Gerando PIX de R$ {valor:.2f}...",
             parse_mode="HTML"
         )
-        pix, erro = criar_pix_mp(user_id, valor, f"StreamFlix Créditos R${valor:.2f}")
+        pix, erro = await asyncio.to_thread(criar_pix_mp, user_id, valor, f"StreamFlix Créditos R${valor:.2f}")
         if erro:
             await q.edit_message_text(
                 f"❌ Erro ao gerar PIX: {erro}\n\nTente novamente mais tarde.",
@@ -652,7 +992,7 @@ async def callback_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("check:"):
         payment_id = data.split(":", 1)[1]
-        status = verificar_pagamento_mp(payment_id)
+        status, _ = await processar_pagamento(payment_id, avisar_usuario=False)
         if status == "approved":
             await q.edit_message_text(
                 "✅ <b>Pagamento confirmado!</b>\nSeu saldo foi atualizado. Use /credito para resgatar.",
@@ -665,12 +1005,12 @@ async def callback_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("resgatar:"):
         tipo = data.split(":", 1)[1]
-        premios = get_premios_disponiveis(tipo)
-        if not premios:
+        info = (await no_banco(estoque_premios)).get(tipo)
+        if not info:
             await q.answer("⚠️ Nenhum prêmio disponível nessa categoria!", show_alert=True)
             return
-        valor = premios[0]["valor"]
-        saldo = get_saldo(user_id)
+        valor = info["valor"]
+        saldo = await no_banco(get_saldo, user_id)
         if saldo < valor:
             await q.answer("💰 Saldo insuficiente!", show_alert=True)
             await q.edit_message_text(
@@ -701,7 +1041,7 @@ async def callback_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("confirmar:"):
         tipo = data.split(":", 1)[1]
-        premio = resgatar_premio(user_id, tipo)
+        premio = await no_banco(resgatar_premio, user_id, tipo)
         if not premio:
             await q.edit_message_text(
                 "❌ Saldo insuficiente ou prêmio indisponível. Use /credito para ver seu saldo.",
@@ -741,16 +1081,12 @@ async def callback_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Avisa admin
         if ADMIN_ID:
             try:
-                from telegram import Bot
-                bot_notify = Bot(token=TOKEN)
-                import asyncio
-                async def _notify_admin():
-                    await bot_notify.send_message(
-                        chat_id=ADMIN_ID,
-                        text=f"🎁 Resgate realizado!\nUser: {user_id}\nTipo: {tipo}\nValor: R$ {premio['valor']:.2f}"
-                    )
-                asyncio.run(_notify_admin())
-            except: pass
+                await envios.executar(ADMIN_ID, lambda: context.bot.send_message(
+                    chat_id=ADMIN_ID,
+                    text=f"🎁 Resgate realizado!\nUser: {user_id}\nTipo: {tipo}\nValor: R$ {premio['valor']:.2f}"
+                ))
+            except Exception as e:
+                logging.warning(f"Aviso de resgate ao admin: {e}")
         await q.edit_message_text(texto, parse_mode="HTML")
 
     elif data == "cancelar":
@@ -758,95 +1094,83 @@ async def callback_credito(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data == "voltar_credito":
         # Redireciona para o menu de créditos
-        user_id2 = q.from_user.id
-        saldo2 = get_saldo(user_id2)
-        premios2 = get_premios_disponiveis()
-        tipos2 = {}
-        for p in premios2:
-            if p["tipo"] not in tipos2:
-                tipos2[p["tipo"]] = {"qtd": 0, "valor": p["valor"]}
-            tipos2[p["tipo"]]["qtd"] += 1
-        NOMES_TIPO2 = {"xtream": "Conta Xtream IPTV", "vip": "Código VIP StreamFlix"}
-        texto2 = f"💰 <b>Seus Créditos StreamFlix</b>\n\n🏦 Saldo atual: <b>R$ {saldo2:.2f}</b>\n\n"
-        botoes2 = []
-        botoes2.append([
-            InlineKeyboardButton("💳 Adicionar R$2,00", callback_data="pix:2.00"),
-            InlineKeyboardButton("💳 Adicionar R$5,99", callback_data="pix:5.99"),
-        ])
-        botoes2.append([
-            InlineKeyboardButton("💳 Adicionar R$10,00", callback_data="pix:10.00"),
-            InlineKeyboardButton("💳 Adicionar R$20,00", callback_data="pix:20.00"),
-        ])
-        for tipo2, info2 in tipos2.items():
-            emoji2 = "📺" if tipo2 == "xtream" else "🎟️" if tipo2 == "vip" else "🎁"
-            botoes2.append([InlineKeyboardButton(
-                f"{emoji2} {NOMES_TIPO2.get(tipo2, tipo2.upper())} — R$ {info2['valor']:.2f}",
-                callback_data=f"resgatar:{tipo2}"
-            )])
-        await q.edit_message_text(texto2, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(botoes2))
+        texto, markup = await no_banco(menu_credito, user_id)
+        await q.edit_message_text(texto, parse_mode="HTML", reply_markup=markup)
 
 # ── Funções de cliente ─────────────────────────────────────────────────────
 
 # ── Sistema de Créditos ────────────────────────────────────────────────────
 def get_saldo(user_id):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT saldo FROM creditos WHERE user_id=%s", (user_id,))
-        r = cur.fetchone(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("SELECT saldo FROM creditos WHERE user_id=%s", (user_id,))
+            r = cur.fetchone()
         return float(r[0]) if r else 0.0
     except: return 0.0
 
 def add_saldo(user_id, valor):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("""INSERT INTO creditos(user_id, saldo) VALUES(%s,%s)
-            ON CONFLICT(user_id) DO UPDATE SET saldo=creditos.saldo+%s, atualizado=NOW()""",
-            (user_id, valor, valor))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("""INSERT INTO creditos(user_id, saldo) VALUES(%s,%s)
+                ON CONFLICT(user_id) DO UPDATE SET saldo=creditos.saldo+%s, atualizado=NOW()""",
+                (user_id, valor, valor))
         return True
     except: return False
 
 def sub_saldo(user_id, valor):
+    """Debita só se houver saldo, numa única instrução (sem ler e comparar em Python)."""
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT saldo FROM creditos WHERE user_id=%s", (user_id,))
-        r = cur.fetchone()
-        if not r or float(r[0]) < valor:
-            cur.close(); c.close(); return False
-        cur.execute("UPDATE creditos SET saldo=saldo-%s, atualizado=NOW() WHERE user_id=%s", (valor, user_id))
-        c.commit(); cur.close(); c.close()
-        return True
+        with db() as cur:
+            cur.execute("""UPDATE creditos SET saldo=saldo-%s, atualizado=NOW()
+                WHERE user_id=%s AND saldo >= %s RETURNING saldo""", (valor, user_id, valor))
+            return cur.fetchone() is not None
     except: return False
 
-def get_premios_disponiveis(tipo=None):
+_estoque_cache = CacheTTL(300, maxsize=1, nome="premios")
+
+def estoque_premios():
+    """{tipo: {"qtd", "valor"}} dos prêmios livres, sem trazer o conteúdo. `valor` é o do próximo a sair."""
+    estoque = _estoque_cache.get("estoque")
+    if estoque is not None: return estoque
     try:
-        c = db(); cur = c.cursor()
-        if tipo:
-            cur.execute("SELECT id, tipo, nome, conteudo, valor, data_exp FROM premios WHERE usado=FALSE AND tipo=%s ORDER BY id", (tipo,))
-        else:
-            cur.execute("SELECT id, tipo, nome, conteudo, valor, data_exp FROM premios WHERE usado=FALSE ORDER BY tipo, id")
-        rows = cur.fetchall(); cur.close(); c.close()
-        return [{"id":r[0],"tipo":r[1],"nome":r[2],"conteudo":r[3],"valor":float(r[4]),"data_exp":r[5]} for r in rows]
-    except: return []
+        with db() as cur:
+            cur.execute("""SELECT tipo, COUNT(*), (ARRAY_AGG(valor ORDER BY id))[1]
+                FROM premios WHERE usado=FALSE GROUP BY tipo ORDER BY tipo""")
+            estoque = {r[0]: {"qtd": r[1], "valor": float(r[2])} for r in cur.fetchall()}
+    except Exception as e:
+        logging.error(f"estoque_premios: {e}"); return {}
+    _estoque_cache.set("estoque", estoque)
+    return estoque
+
+def invalidar_estoque():
+    _estoque_cache.invalidar()
 
 def resgatar_premio(user_id, tipo):
+    """Reserva o próximo prêmio livre (SKIP LOCKED: resgates simultâneos pegam prêmios diferentes),
+    debita o saldo, baixa o prêmio e registra o resgate numa só ida ao banco."""
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT id, nome, conteudo, valor, data_exp FROM premios WHERE usado=FALSE AND tipo=%s ORDER BY id LIMIT 1 FOR UPDATE", (tipo,))
-        r = cur.fetchone()
+        with db() as cur:
+            cur.execute("""WITH premio AS (
+                    SELECT id, nome, conteudo, valor, data_exp FROM premios
+                    WHERE usado=FALSE AND tipo=%s ORDER BY id LIMIT 1
+                    FOR UPDATE SKIP LOCKED),
+                debito AS (
+                    UPDATE creditos c SET saldo=c.saldo-p.valor, atualizado=NOW()
+                    FROM premio p WHERE c.user_id=%s AND c.saldo >= p.valor
+                    RETURNING c.saldo),
+                baixa AS (
+                    UPDATE premios SET usado=TRUE FROM premio p, debito
+                    WHERE premios.id=p.id),
+                registro AS (
+                    INSERT INTO resgates(user_id, premio_id, valor)
+                    SELECT %s, p.id, p.valor FROM premio p, debito)
+                SELECT p.nome, p.conteudo, p.valor, p.data_exp, d.saldo FROM premio p, debito d""",
+                (tipo, user_id, user_id))
+            r = cur.fetchone()
         if not r:
-            cur.close(); c.close(); return None
-        pid, nome, conteudo, valor, data_exp = r
-        # Desconta saldo
-        cur.execute("SELECT saldo FROM creditos WHERE user_id=%s", (user_id,))
-        sr = cur.fetchone()
-        if not sr or float(sr[0]) < float(valor):
-            cur.close(); c.close(); return None
-        cur.execute("UPDATE creditos SET saldo=saldo-%s WHERE user_id=%s", (valor, user_id))
-        cur.execute("UPDATE premios SET usado=TRUE WHERE id=%s", (pid,))
-        cur.execute("INSERT INTO resgates(user_id,premio_id,valor) VALUES(%s,%s,%s)", (user_id, pid, valor))
-        c.commit(); cur.close(); c.close()
-        return {"nome":nome,"conteudo":conteudo,"valor":float(valor),"data_exp":data_exp}
+            return None   # sem prêmio livre ou saldo insuficiente
+        invalidar_estoque()
+        return {"nome":r[0],"conteudo":r[1],"valor":float(r[2]),"data_exp":r[3],"saldo":float(r[4])}
     except Exception as e:
         logging.error(f"resgatar_premio: {e}"); return None
 
@@ -878,14 +1202,44 @@ def criar_pix_mp(user_id, valor, descricao):
         payment_id = str(data["id"])
         pix_code = data.get("point_of_interaction",{}).get("transaction_data",{}).get("qr_code","")
         # Salva no banco
-        c = db(); cur = c.cursor()
-        cur.execute("INSERT INTO pagamentos(payment_id,user_id,valor) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING",
-            (payment_id, user_id, valor))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("INSERT INTO pagamentos(payment_id,user_id,valor) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING",
+                (payment_id, user_id, valor))
         return {"payment_id": payment_id, "pix_code": pix_code, "valor": valor}, None
     except Exception as e:
         return None, str(e)
 
+def aplicar_pagamentos(payment_ids):
+    """Credita pagamentos aprovados numa única instrução: só a primeira chamada encontra
+    status='pending', as repetidas não fazem nada. Retorna [(user_id, valor, saldo)] por usuário."""
+    with db() as cur:
+        cur.execute("""WITH pago AS (
+                UPDATE pagamentos SET status='approved', aprovado_em=NOW()
+                WHERE payment_id = ANY(%s) AND status='pending'
+                RETURNING user_id, valor),
+            soma AS (SELECT user_id, SUM(valor) AS valor FROM pago GROUP BY user_id)
+            INSERT INTO creditos(user_id, saldo) SELECT user_id, valor FROM soma
+            ON CONFLICT(user_id) DO UPDATE SET saldo=creditos.saldo+EXCLUDED.saldo, atualizado=NOW()
+            RETURNING user_id, (SELECT valor FROM soma WHERE soma.user_id=creditos.user_id), saldo""",
+            (list(payment_ids),))
+        rows = cur.fetchall()
+    return [(r[0], float(r[1]), float(r[2])) for r in rows]
+
+def aplicar_pagamento(payment_id):
+    r = aplicar_pagamentos([payment_id])
+    return r[0] if r else None
+
+def encerrar_pagamentos(finais):
+    """Grava o status final (rejected, cancelled, expired…) de pagamentos ainda pendentes."""
+    if not finais: return 0
+    with db() as cur:
+        encerrados = execute_values(cur, """UPDATE pagamentos p SET status=v.status
+            FROM (VALUES %s) AS v(payment_id, status)
+            WHERE p.payment_id=v.payment_id AND p.status='pending'
+            RETURNING p.payment_id""", list(finais.items()), fetch=True)
+        # rowcount só veria a última página do execute_values; o RETURNING junta todas
+        return len(encerrados)
+
 def verificar_pagamento_mp(payment_id):
     """Verifica status de um pagamento no MP."""
     if not MP_TOKEN: return None
@@ -897,9 +1251,9 @@ def verificar_pagamento_mp(payment_id):
 
 def set_nome_canal(chat_id, nome):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("UPDATE clientes SET nome_canal=%s WHERE chat_id=%s", (nome, chat_id))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("UPDATE clientes SET nome_canal=%s WHERE chat_id=%s", (nome, chat_id))
+        invalidar_cliente(chat_id)
         return True
     except: return False
 
@@ -907,86 +1261,135 @@ def gerar_token():
     chars = string.ascii_uppercase + string.digits
     token = "SF-" + "".join(secrets.choice(chars) for _ in range(10))
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("INSERT INTO tokens (token) VALUES (%s)", (token,))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("INSERT INTO tokens (token) VALUES (%s)", (token,))
     except Exception as e:
         logging.error(e)
     return token
 
 def token_valido(token):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT token FROM tokens WHERE token=%s AND usado=FALSE", (token,))
-        r = cur.fetchone(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("SELECT token FROM tokens WHERE token=%s AND usado=FALSE", (token,))
+            r = cur.fetchone()
         return r is not None
     except: return False
 
 def usar_token(token, chat_id, topic_id=0):
     try:
-        c = db(); cur = c.cursor()
-        validade = datetime.utcnow() + timedelta(days=DIAS_PLANO)
-        cur.execute("""INSERT INTO clientes (chat_id, topic_id, token, ativo, validade)
-            VALUES (%s,%s,%s,TRUE,%s)
-            ON CONFLICT (chat_id) DO UPDATE
-            SET token=%s, ativo=TRUE, validade=%s, aviso_3d=FALSE, aviso_venc=FALSE""",
-            (chat_id, topic_id, token, validade, token, validade))
-        cur.execute("UPDATE tokens SET usado=TRUE WHERE token=%s", (token,))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            validade = datetime.utcnow() + timedelta(days=DIAS_PLANO)
+            cur.execute("""INSERT INTO clientes (chat_id, topic_id, token, ativo, validade)
+                VALUES (%s,%s,%s,TRUE,%s)
+                ON CONFLICT (chat_id) DO UPDATE
+                SET token=%s, ativo=TRUE, validade=%s, aviso_3d=FALSE, aviso_venc=FALSE""",
+                (chat_id, topic_id, token, validade, token, validade))
+            cur.execute("UPDATE tokens SET usado=TRUE WHERE token=%s", (token,))
+        invalidar_cliente(chat_id)
         return validade
     except Exception as e:
         logging.error(e); return None
 
+# Cache das configurações de cada cliente: uma linha de `clientes` por chat_id
+CLIENTE_CACHE_TTL = int(os.environ.get("CLIENTE_CACHE_TTL", "300"))
+CAMPOS_CLIENTE    = ("ativo", "validade", "topic_id", "modo", "site_url", "nome_canal", "entrega")
+_clientes_cache   = CacheTTL(CLIENTE_CACHE_TTL, maxsize=5000, nome="clientes")
+
+def _ler_cliente(chat_id):
+    with db() as cur:
+        cur.execute(f"SELECT {', '.join(CAMPOS_CLIENTE)} FROM clientes WHERE chat_id=%s", (chat_id,))
+        r = cur.fetchone()
+    cfg = dict(zip(CAMPOS_CLIENTE, r)) if r else False   # False = não cadastrado
+    _clientes_cache.set(chat_id, cfg)
+    return cfg
+
+def get_cliente(chat_id):
+    """Configurações do cliente (dict com CAMPOS_CLIENTE) ou None se não existe."""
+    cfg = _clientes_cache.get(chat_id)
+    if cfg is None: cfg = _ler_cliente(chat_id)
+    return cfg or None
+
+async def get_cliente_async(chat_id):
+    """Como get_cliente, mas só sai do loop quando o cache está frio.
+    Depois dela, cliente_ativo/get_modo/get_site_url/... respondem da memória."""
+    cfg = _clientes_cache.get(chat_id)
+    if cfg is None: cfg = await no_banco(_ler_cliente, chat_id)
+    return cfg or None
+
+async def cliente_ativo_async(chat_id):
+    if chat_id != GRUPO_ID:
+        try: await get_cliente_async(chat_id)
+        except Exception: return False
+    return cliente_ativo(chat_id)
+
+def invalidar_cliente(chat_id=None):
+    """Chamar sempre que uma linha de `clientes` mudar."""
+    _clientes_cache.invalidar(chat_id)
+
 def cliente_ativo(chat_id):
     if chat_id == GRUPO_ID: return True  # canal do dono sempre liberado
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT ativo, validade FROM clientes WHERE chat_id=%s", (chat_id,))
-        r = cur.fetchone(); cur.close(); c.close()
-        if not r: return False
-        ativo, validade = r
-        if not ativo: return False
-        if validade and datetime.utcnow() > validade: return False
+        cfg = get_cliente(chat_id)
+        if not cfg or not cfg["ativo"]: return False
+        if cfg["validade"] and datetime.utcnow() > cfg["validade"]: return False
         return True
     except: return False
 
 def get_topic_id(chat_id):
     if chat_id == GRUPO_ID: return TOPIC_ID
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT topic_id FROM clientes WHERE chat_id=%s", (chat_id,))
-        r = cur.fetchone(); cur.close(); c.close()
-        return r[0] if r else 0
+        cfg = get_cliente(chat_id)
+        return (cfg["topic_id"] or 0) if cfg else 0
     except: return 0
 
+def chats_ativos():
+    """Chats que recebem as postagens automáticas: clientes em dia + canais do dono."""
+    try:
+        with db() as cur:
+            cur.execute("SELECT chat_id FROM clientes WHERE ativo=TRUE AND validade > NOW()")
+            chats = [r[0] for r in cur.fetchall()]
+    except: chats = []
+    if GRUPO_ID and GRUPO_ID not in chats: chats.append(GRUPO_ID)
+    if CANAL_VIP and CANAL_VIP not in chats: chats.append(CANAL_VIP)
+    return chats
+
+def contar_clientes():
+    """(ativos, vencidos/inativos, tokens livres) numa consulta só."""
+    with db() as cur:
+        cur.execute("""SELECT COUNT(*) FILTER (WHERE ativo=TRUE AND validade > NOW()),
+                              COUNT(*) FILTER (WHERE ativo=FALSE OR validade <= NOW()),
+                              (SELECT COUNT(*) FROM tokens WHERE usado=FALSE)
+                       FROM clientes""")
+        return cur.fetchone()
+
 def listar_clientes():
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT chat_id, ativo, validade, criado_em FROM clientes ORDER BY criado_em DESC")
-        rows = cur.fetchall(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("SELECT chat_id, ativo, validade, criado_em FROM clientes ORDER BY criado_em DESC")
+            rows = cur.fetchall()
         return rows
     except: return []
 
 def renovar_cliente(chat_id):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT validade FROM clientes WHERE chat_id=%s", (chat_id,))
-        r = cur.fetchone()
-        if not r: return None
-        base = max(r[0], datetime.utcnow()) if r[0] else datetime.utcnow()
-        nova = base + timedelta(days=DIAS_PLANO)
-        cur.execute("""UPDATE clientes SET ativo=TRUE, validade=%s,
-            aviso_3d=FALSE, aviso_venc=FALSE WHERE chat_id=%s""", (nova, chat_id))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("SELECT validade FROM clientes WHERE chat_id=%s", (chat_id,))
+            r = cur.fetchone()
+            if not r: return None
+            base = max(r[0], datetime.utcnow()) if r[0] else datetime.utcnow()
+            nova = base + timedelta(days=DIAS_PLANO)
+            cur.execute("""UPDATE clientes SET ativo=TRUE, validade=%s,
+                aviso_3d=FALSE, aviso_venc=FALSE WHERE chat_id=%s""", (nova, chat_id))
+        invalidar_cliente(chat_id)
         return nova
     except Exception as e:
         logging.error(e); return None
 
 def revogar_cliente(chat_id):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("UPDATE clientes SET ativo=FALSE WHERE chat_id=%s", (chat_id,))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("UPDATE clientes SET ativo=FALSE WHERE chat_id=%s", (chat_id,))
+        invalidar_cliente(chat_id)
         return True
     except: return False
 
@@ -994,97 +1397,232 @@ def get_modo(chat_id):
     """Retorna o modo do cliente: 'completo' (padrão) ou 'simples'."""
     if chat_id == GRUPO_ID: return "completo"
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT modo FROM clientes WHERE chat_id=%s", (chat_id,))
-        r = cur.fetchone(); cur.close(); c.close()
-        return (r[0] if r and r[0] else "completo")
+        cfg = get_cliente(chat_id)
+        return (cfg["modo"] if cfg and cfg["modo"] else "completo")
     except: return "completo"
 
 def set_modo(chat_id, modo):
     """Define modo 'completo' ou 'simples' para um cliente."""
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("UPDATE clientes SET modo=%s WHERE chat_id=%s", (modo, chat_id))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("UPDATE clientes SET modo=%s WHERE chat_id=%s", (modo, chat_id))
+        invalidar_cliente(chat_id)
         return True
     except Exception as e:
         logging.error(e); return False
 
+# Entrega de cada item: 'separado' = foto + mensagem do trailer (2 envios);
+# 'botao' = trailer como botão na foto; 'legenda' = link do trailer na legenda (1 envio)
+ENTREGAS = ("separado", "botao", "legenda")
+if ENTREGA_PADRAO not in ENTREGAS:
+    logging.warning(f"ENTREGA_PADRAO={ENTREGA_PADRAO!r} inválido (use {', '.join(ENTREGAS)}); usando 'separado'")
+    ENTREGA_PADRAO = "separado"
+
+def get_entrega(chat_id):
+    if chat_id == GRUPO_ID: return ENTREGA_PADRAO
+    try:
+        cfg = get_cliente(chat_id)
+        return (cfg["entrega"] if cfg and cfg["entrega"] else ENTREGA_PADRAO)
+    except: return ENTREGA_PADRAO
+
+def set_entrega(chat_id, entrega):
+    try:
+        with db() as cur:
+            cur.execute("UPDATE clientes SET entrega=%s WHERE chat_id=%s", (entrega, chat_id))
+            ok = cur.rowcount > 0
+        invalidar_cliente(chat_id)
+        return ok
+    except Exception as e:
+        logging.error(e); return False
+
 def get_site_url(chat_id):
     """Retorna o site_url personalizado do cliente, ou o SITE_URL padrão."""
     if chat_id == GRUPO_ID: return SITE_URL
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT site_url FROM clientes WHERE chat_id=%s", (chat_id,))
-        r = cur.fetchone(); cur.close(); c.close()
-        return (r[0] if r and r[0] else SITE_URL)
+        cfg = get_cliente(chat_id)
+        return (cfg["site_url"] if cfg and cfg["site_url"] else SITE_URL)
     except: return SITE_URL
 
 def set_site_url(chat_id, url):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("UPDATE clientes SET site_url=%s WHERE chat_id=%s", (url or None, chat_id))
-        c.commit(); cur.close(); c.close()
+        with db() as cur:
+            cur.execute("UPDATE clientes SET site_url=%s WHERE chat_id=%s", (url or None, chat_id))
+        invalidar_cliente(chat_id)
         return True
     except Exception as e:
         logging.error(e); return False
 
+def marcar_avisos_3d():
+    """Marca de uma vez quem vence nos próximos 3 dias e ainda não foi avisado; retorna esses chat_ids."""
+    with db() as cur:
+        cur.execute("""UPDATE clientes SET aviso_3d=TRUE
+            WHERE ativo=TRUE AND aviso_3d=FALSE
+              AND validade > NOW() AND validade <= NOW() + INTERVAL '3 days'
+            RETURNING chat_id""")
+        return [r[0] for r in cur.fetchall()]
+
+def desmarcar_avisos_3d(chats):
+    """Devolve o aviso de 3 dias pra fila de quem não recebeu (a próxima rodada tenta de novo)."""
+    if not chats: return
+    with db() as cur:
+        cur.execute("UPDATE clientes SET aviso_3d=FALSE WHERE chat_id = ANY(%s)", (list(chats),))
+
+def marcar_vencidos():
+    """Bloqueia de uma vez quem venceu e ainda não foi avisado; retorna esses chat_ids."""
+    with db() as cur:
+        cur.execute("""UPDATE clientes SET ativo=FALSE, aviso_venc=TRUE
+            WHERE ativo=TRUE AND aviso_venc=FALSE AND validade < NOW()
+            RETURNING chat_id""")
+        vencidos = [r[0] for r in cur.fetchall()]
+    for cid in vencidos: invalidar_cliente(cid)
+    return vencidos
 
-    try:
-        c = db(); cur = c.cursor()
-        limite = datetime.utcnow() + timedelta(days=3)
-        cur.execute("""SELECT chat_id FROM clientes
-            WHERE ativo=TRUE AND validade <= %s AND aviso_3d=FALSE""", (limite,))
-        rows = [r[0] for r in cur.fetchall()]; cur.close(); c.close()
-        return rows
-    except: return []
+# ── TMDB ───────────────────────────────────────────────────────────────────
+TMDB_CONCORRENCIA = int(os.environ.get("TMDB_CONCORRENCIA", "8"))  # requisições simultâneas
+TMDB_TENTATIVAS   = 3
+TMDB_CACHE_MAX    = int(os.environ.get("TMDB_CACHE_MAX", "2000"))
+TMDB_CACHE_ARQUIVO = os.environ.get("TMDB_CACHE_ARQUIVO", "")      # vazio = só memória
+
+# TTL por endpoint (primeira regra que casar); detalhes mudam pouco, trending muda rápido
+TMDB_TTLS = [
+    (re.compile(r"^(movie|tv)/\d+(/videos)?$"),        24 * 3600),
+    (re.compile(r"^person/\d+/movie_credits$"),        24 * 3600),
+    (re.compile(r"^trending/"),                         30 * 60),
+    (re.compile(r"^(movie|tv)/[a-z_]+$|^discover/"),     3 * 3600),
+    (re.compile(r"^search/"),                           3600),
+]
+TMDB_TTL_PADRAO = 3600
+
+_tmdb_cache = CacheTTL(TMDB_TTL_PADRAO, maxsize=TMDB_CACHE_MAX, nome="tmdb")
+
+_tmdb_http   = None   # httpx.AsyncClient com keep-alive, preso ao loop que o criou
+_tmdb_sem    = None
+_tmdb_loop   = None
+_tmdb_em_voo = {}     # chave → Future de uma busca em andamento (evita buscas duplicadas)
+
+async def _tmdb_cliente():
+    global _tmdb_http, _tmdb_sem, _tmdb_loop, _tmdb_em_voo
+    loop = asyncio.get_running_loop()
+    if _tmdb_http is None or _tmdb_loop is not loop:
+        if _tmdb_http is not None:
+            # Cliente de um loop anterior (main() reiniciou): fecha antes de abrir outro
+            antigo, _tmdb_http = _tmdb_http, None
+            try: await antigo.aclose()
+            except Exception as e: logging.warning(f"TMDB: cliente antigo não fechou direito: {e!r}")
+        _tmdb_http = httpx.AsyncClient(
+            base_url=TMDB_BASE, timeout=15,
+            limits=httpx.Limits(max_connections=TMDB_CONCORRENCIA,
+                                max_keepalive_connections=TMDB_CONCORRENCIA))
+        _tmdb_sem    = asyncio.Semaphore(TMDB_CONCORRENCIA)
+        _tmdb_em_voo = {}
+        _tmdb_loop   = loop
+    return _tmdb_http, _tmdb_sem
+
+async def fechar_tmdb():
+    global _tmdb_http
+    if _tmdb_http is not None:
+        await _tmdb_http.aclose()
+        _tmdb_http = None
+
+def _ttl_tmdb(endpoint):
+    return next((ttl for regra, ttl in TMDB_TTLS if regra.search(endpoint)), TMDB_TTL_PADRAO)
+
+async def _tmdb_buscar(endpoint, p):
+    http, sem = await _tmdb_cliente()
+    rotulo = re.sub(r"\d+", ":id", endpoint)   # movie/123 → movie/:id (poucas séries no /metrics)
+    for tentativa in range(TMDB_TENTATIVAS):
+        espera = 0.0
+        try:
+            async with sem:
+                with metricas.cronometro("streamflix_tmdb_segundos", endpoint=rotulo):
+                    r = await http.get(endpoint, params=p)
+            metricas.contar("streamflix_tmdb_requisicoes_total", endpoint=rotulo, status=r.status_code)
+            if r.status_code == 429 or r.status_code >= 500:
+                logging.warning(f"TMDB {endpoint}: HTTP {r.status_code}")
+                espera = float(r.headers.get("Retry-After") or 0)
+            elif r.status_code >= 400:
+                logging.warning(f"TMDB {endpoint}: HTTP {r.status_code}"); return None
+            else:
+                return r.json()
+        except (httpx.HTTPError, ValueError) as e:
+            metricas.contar("streamflix_tmdb_requisicoes_total", endpoint=rotulo, status="erro")
+            logging.warning(f"TMDB {endpoint}: {e!r}")
+        if tentativa + 1 < TMDB_TENTATIVAS:
+            # Backoff exponencial com jitter
+            await asyncio.sleep(max(espera, 0.5 * 2 ** tentativa * random.uniform(0.5, 1.5)))
+    return None
 
-def clientes_vencidos():
-    try:
-        c = db(); cur = c.cursor()
-        cur.execute("""SELECT chat_id FROM clientes
-            WHERE ativo=TRUE AND validade < NOW() AND aviso_venc=FALSE""")
-        rows = [r[0] for r in cur.fetchall()]; cur.close(); c.close()
-        return rows
-    except: return []
+async def tmdb(endpoint, params=None):
+    """GET na API do TMDB sem bloquear o loop; retorna o JSON ou None.
 
-def marcar_aviso_3d(chat_id):
+    Respostas ficam no cache por endpoint+params, e chamadas simultâneas
+    para a mesma chave esperam a mesma requisição.
+    """
+    p = {"api_key": TMDB_KEY, "language": "pt-BR", **(params or {})}
+    chave = endpoint + "?" + urlencode(sorted((k, v) for k, v in p.items() if k != "api_key"))
+    d = _tmdb_cache.get(chave)
+    if d is not None: return d
+    await _tmdb_cliente()
+    voo = _tmdb_em_voo.get(chave)
+    if voo is None:
+        # A busca roda numa task própria: se quem a iniciou for cancelado, os outros seguem esperando
+        voo = _tmdb_em_voo[chave] = asyncio.ensure_future(_tmdb_buscar_e_guardar(chave, endpoint, p))
+        voo.add_done_callback(lambda f: _tmdb_em_voo.get(chave) is f and _tmdb_em_voo.pop(chave))
+    return await asyncio.shield(voo)
+
+async def _tmdb_buscar_e_guardar(chave, endpoint, p):
+    d = await _tmdb_buscar(endpoint, p)
+    if d is not None: _tmdb_cache.set(chave, d, ttl=_ttl_tmdb(endpoint))
+    return d
+
+def carregar_cache_tmdb():
+    """Recarrega do disco as respostas que ainda não expiraram."""
+    if not TMDB_CACHE_ARQUIVO or not os.path.exists(TMDB_CACHE_ARQUIVO): return
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("UPDATE clientes SET aviso_3d=TRUE WHERE chat_id=%s", (chat_id,))
-        c.commit(); cur.close(); c.close()
-    except: pass
+        with open(TMDB_CACHE_ARQUIVO, encoding="utf-8") as f:
+            itens = json.load(f)
+        agora = time.time()
+        for chave, expira, valor in itens:
+            if expira > agora: _tmdb_cache.set(chave, valor, ttl=expira - agora)
+        logging.info(f"Cache TMDB: {len(_tmdb_cache)} respostas carregadas do disco")
+    except Exception as e:
+        logging.warning(f"Cache TMDB (leitura): {e}")
 
-def marcar_vencido(chat_id):
+def salvar_cache_tmdb():
+    if not TMDB_CACHE_ARQUIVO: return
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("UPDATE clientes SET ativo=FALSE, aviso_venc=TRUE WHERE chat_id=%s", (chat_id,))
-        c.commit(); cur.close(); c.close()
-    except: pass
+        agora = time.time()
+        itens = [(k, agora + restante, v) for k, restante, v in _tmdb_cache.exportar()]
+        tmp = TMDB_CACHE_ARQUIVO + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(itens, f)
+        os.replace(tmp, TMDB_CACHE_ARQUIVO)
+    except Exception as e:
+        logging.warning(f"Cache TMDB (gravação): {e}")
 
-# ── TMDB ───────────────────────────────────────────────────────────────────
-def tmdb(endpoint, params=None):
-    p = {"api_key": TMDB_KEY, "language": "pt-BR", **(params or {})}
-    for _ in range(2):
-        try:
-            r = requests.get(f"{TMDB_BASE}/{endpoint}", params=p, timeout=15)
-            r.raise_for_status(); return r.json()
-        except Exception as e:
-            logging.warning(e); time.sleep(1)
-    return None
+async def job_salvar_cache(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(salvar_cache_tmdb)
 
-def tmdb_details(item_id, is_tv=False):
+async def tmdb_details(item_id, is_tv=False):
     tipo = "tv" if is_tv else "movie"
-    return tmdb(f"{tipo}/{item_id}", {"append_to_response": "credits,videos"})
-
-def get_trailer_url(item_id, titulo, is_tv=False):
-    v = tmdb(f"{'tv' if is_tv else 'movie'}/{item_id}/videos")
-    if v and v.get("results"):
-        res = v["results"]
-        t = next((x for x in res if x["type"]=="Trailer" and x["site"]=="YouTube"), None)
-        if t: return f"https://youtu.be/{t['key']}"
-        yt = next((x for x in res if x["site"]=="YouTube"), None)
-        if yt: return f"https://youtu.be/{yt['key']}"
+    # Vídeos em pt e en já vêm junto dos detalhes; o trailer sai daqui sem outra chamada
+    return await tmdb(f"{tipo}/{item_id}", {"append_to_response": "credits,videos",
+                                           "include_video_language": "pt,en,null"})
+
+async def get_trailer_url(details, titulo, is_tv=False):
+    """Link do trailer a partir do bloco `videos` dos detalhes.
+
+    Só consulta /videos em inglês quando os detalhes não trouxeram nenhum vídeo.
+    """
+    res = (details.get("videos") or {}).get("results") or []
+    if not res and details.get("id"):
+        v = await tmdb(f"{'tv' if is_tv else 'movie'}/{details['id']}/videos", {"language": "en-US"})
+        res = (v or {}).get("results") or []
+    yt = [x for x in res if x.get("site") == "YouTube"]
+    t = (next((x for x in yt if x.get("type") == "Trailer" and x.get("iso_639_1") == "pt"), None)
+         or next((x for x in yt if x.get("type") == "Trailer"), None)
+         or (yt[0] if yt else None))
+    if t: return f"https://youtu.be/{t['key']}"
     return f"https://www.youtube.com/results?search_query={quote(titulo+' Trailer Oficial')}"
 
 def link_streamflix(item_id, is_tv=False):
@@ -1147,83 +1685,446 @@ def build_caption(details, is_tv=False):
     if dir_val:  linhas.append(f"{dir_label}: {html.escape(dir_val)}")
     return "\n".join(linhas)
 
+TEMPLATE_VERSAO = 1   # suba ao mudar build_caption ou os botões: descarta o que já foi renderizado
+_render_cache   = CacheTTL(6 * 3600, maxsize=2048, nome="render")
+_CAMPOS_LEGENDA = ("title", "name", "original_title", "original_name", "release_date", "first_air_date",
+                   "vote_average", "vote_count", "overview", "genres", "number_of_seasons",
+                   "number_of_episodes", "status", "runtime", "created_by")
+
+def _versao_detalhes(details):
+    """Hash curto dos campos que entram na legenda: detalhe renovado com outra nota/sinopse gera outra chave."""
+    credits = details.get("credits") or {}
+    campos  = {k: details.get(k) for k in _CAMPOS_LEGENDA}
+    campos["cast"] = [p.get("name") for p in credits.get("cast", [])[:5]]
+    campos["crew"] = [p.get("name") for p in credits.get("crew", []) if p.get("job") == "Director"][:2]
+    return hashlib.sha1(json.dumps(campos, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def renderizar_item(iid, details, is_tv, modo, site, entrega="separado", trailer=None, cachear=True):
+    """Legenda + teclado prontos, reaproveitados entre clientes com o mesmo modo/site/entrega/trailer.
+    Só entra no cache o que veio dos detalhes completos do TMDB (`cachear`), e pelo mesmo TTL deles."""
+    chave = (iid, is_tv, modo, site, entrega, trailer, _versao_detalhes(details) if cachear else None,
+             TEMPLATE_VERSAO)
+    feito = _render_cache.get(chave) if cachear else None
+    if feito: return feito
+    caption = build_caption(details, is_tv=is_tv)
+    if entrega == "legenda" and trailer:
+        caption += f'\n\n🎬 <a href="{html.escape(trailer)}">Assista ao trailer</a>'
+
+    # modo 'completo': botão site personalizado; modo 'simples': só assistir
+    if modo == "simples":
+        keyboard = [
+            [InlineKeyboardButton("▶️ ASSISTIR AGORA", url=link_streamflix(iid, is_tv=is_tv))]
+        ]
+    else:
+        keyboard = [
+            [InlineKeyboardButton("▶️ ASSISTIR AGORA",    url=link_streamflix(iid, is_tv=is_tv))],
+            [InlineKeyboardButton("🌐 Visite nosso Site", url=site)]
+        ]
+    if entrega == "botao" and trailer:
+        keyboard.insert(1, [InlineKeyboardButton("🎬 Trailer", url=trailer)])
+    markup = InlineKeyboardMarkup(keyboard)
+    if cachear:
+        _render_cache.set(chave, (caption, markup), ttl=_ttl_tmdb(f"{'tv' if is_tv else 'movie'}/{iid}"))
+    return caption, markup
+
 # ── Itens enviados por cliente ─────────────────────────────────────────────
+SENT_LOTE = 500   # marcações acumuladas antes de gravar em sent_items
+
+_enviados_buffer = {}   # (chat_id, item_id, item_type) → sent_at ainda não gravado
+_enviados_lock   = threading.Lock()
+
+def _corte_repeticao():
+    return datetime.utcnow() - timedelta(days=DIAS_SEM_REPETIR)
+
+def _buffer_do_tipo(tipo, chats=None):
+    with _enviados_lock:
+        return [(c, i) for (c, i, t) in _enviados_buffer if t == tipo and (chats is None or c in chats)]
+
 def ja_enviados(chat_id, tipo):
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT item_id FROM sent_items WHERE chat_id=%s AND item_type=%s AND sent_at>%s",
-                    (chat_id, tipo, datetime.utcnow()-timedelta(days=DIAS_SEM_REPETIR)))
-        ids = {r[0] for r in cur.fetchall()}; cur.close(); c.close()
-        return ids
-    except: return set()
+        with db() as cur:
+            cur.execute("SELECT item_id FROM sent_items WHERE chat_id=%s AND item_type=%s AND sent_at>%s",
+                        (chat_id, tipo, _corte_repeticao()))
+            ids = {r[0] for r in cur.fetchall()}
+    except: ids = set()
+    return ids | {i for c, i in _buffer_do_tipo(tipo, {chat_id})}
+
+def ja_enviados_lote(chat_ids, tipo):
+    """Conjuntos de exclusão de vários chats numa única consulta: {chat_id: {item_id, ...}}."""
+    enviados = {cid: set() for cid in chat_ids}
+    try:
+        with db() as cur:
+            cur.execute("""SELECT chat_id, item_id FROM sent_items
+                WHERE chat_id = ANY(%s) AND item_type=%s AND sent_at>%s""",
+                (list(chat_ids), tipo, _corte_repeticao()))
+            rows = cur.fetchall()
+    except Exception as e:
+        logging.error(f"ja_enviados_lote: {e}"); rows = []
+    for cid, iid in rows + _buffer_do_tipo(tipo, enviados.keys()):
+        enviados[cid].add(iid)
+    return enviados
 
 def marcar_enviado(chat_id, item_id, tipo):
+    """Acumula a marcação. Retorna True quando o buffer chegou a SENT_LOTE e deve ir para o banco."""
+    with _enviados_lock:
+        _enviados_buffer[(chat_id, item_id, tipo)] = datetime.utcnow()
+        return len(_enviados_buffer) >= SENT_LOTE
+
+def flush_enviados():
+    """Grava as marcações pendentes com um único INSERT … ON CONFLICT em lote."""
+    with _enviados_lock:
+        if not _enviados_buffer: return 0
+        linhas = [(c, i, t, ts) for (c, i, t), ts in _enviados_buffer.items()]
+        _enviados_buffer.clear()
     try:
-        c = db(); cur = c.cursor()
-        cur.execute("""INSERT INTO sent_items VALUES(%s,%s,%s,%s)
-            ON CONFLICT(chat_id,item_id,item_type) DO UPDATE SET sent_at=EXCLUDED.sent_at""",
-            (chat_id, item_id, tipo, datetime.utcnow()))
-        c.commit(); cur.close(); c.close()
-    except Exception as e: logging.error(e)
-
-def filtrar(chat_id, itens, tipo):
-    env   = ja_enviados(chat_id, tipo)
+        # Particionada: a PK inclui sent_at, então cada envio é uma linha nova
+        conflito = ("ON CONFLICT DO NOTHING" if _sent_particionado else
+                    "ON CONFLICT(chat_id,item_id,item_type) DO UPDATE SET sent_at=EXCLUDED.sent_at")
+        with db() as cur:
+            execute_values(cur, f"""INSERT INTO sent_items(chat_id, item_id, item_type, sent_at) VALUES %s
+                {conflito}""", linhas, page_size=1000)
+        return len(linhas)
+    except Exception as e:
+        logging.error(f"flush_enviados: {e}")
+        with _enviados_lock:   # devolve ao buffer para a próxima tentativa
+            for c, i, t, ts in linhas: _enviados_buffer.setdefault((c, i, t), ts)
+        return 0
+
+async def job_flush_enviados(context: ContextTypes.DEFAULT_TYPE):
+    await no_banco(flush_enviados)
+
+def filtrar(chat_id, itens, tipo, enviados=None):
+    env   = ja_enviados(chat_id, tipo) if enviados is None else enviados
     novos = [i for i in itens if i.get("id") not in env]
-    return novos if novos else itens
+    return novos if novos else list(itens)   # cópia: a lista pode vir do cache do TMDB
+
+# ── Agendador de envios (limites do Telegram) ─────────────────────────────
+ENVIO_GLOBAL_POR_S  = float(os.environ.get("ENVIO_GLOBAL_POR_S", "25"))   # Telegram: ~30 msg/s por bot
+ENVIO_CHAT_POR_MIN  = float(os.environ.get("ENVIO_CHAT_POR_MIN", "20"))   # Telegram: ~20 msg/min por grupo
+ENVIO_CHAT_RAJADA   = 10     # mensagens seguidas permitidas num chat antes de espaçar
+ENVIO_TENTATIVAS    = 3      # tentativas quando o Telegram responde RetryAfter
+PRIO_INTERATIVO, PRIO_BROADCAST = 0, 1   # respostas a usuários passam na frente dos disparos
+
+class _Balde:
+    """Token bucket: `taxa` fichas por segundo, até `capacidade` acumuladas."""
+
+    def __init__(self, taxa, capacidade):
+        self.taxa       = taxa
+        self.capacidade = capacidade
+        self.fichas     = capacidade
+        self.ts         = time.monotonic()
+        self.pausa_ate  = 0.0      # RetryAfter recebido para este balde
+
+    def espera(self):
+        """Consome uma ficha e retorna 0, ou retorna quantos segundos faltam para haver uma."""
+        agora = time.monotonic()
+        if agora < self.pausa_ate: return self.pausa_ate - agora
+        self.fichas = min(self.capacidade, self.fichas + (agora - self.ts) * self.taxa)
+        self.ts = agora
+        if self.fichas >= 1:
+            self.fichas -= 1; return 0.0
+        return (1 - self.fichas) / self.taxa
+
+    def ocioso(self):
+        agora = time.monotonic()
+        return agora >= self.pausa_ate and self.fichas + (agora - self.ts) * self.taxa >= self.capacidade
+
+class AgendadorEnvio:
+    """Ponto único por onde passam as chamadas de envio ao Telegram.
+
+    Aplica um balde por chat e um balde global; quem espera pelo global é
+    atendido por prioridade (interativo antes de broadcast) e, na mesma
+    prioridade, por ordem de chegada. RetryAfter pausa o chat afetado e a
+    chamada é repetida depois do prazo pedido pelo Telegram.
+    """
+
+    def __init__(self):
+        self._loop = None
+
+    def _preparar(self):
+        # Estado assíncrono preso ao loop atual (main() pode recriar o loop)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop   = loop
+            self._global = _Balde(ENVIO_GLOBAL_POR_S, ENVIO_GLOBAL_POR_S)
+            self._chats  = {}
+            self._fila   = []        # heap de (prioridade, seq, future)
+            self._seq    = itertools.count()
+            self._bomba  = None
+
+    def _balde_chat(self, chat_id):
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10000:   # descarta baldes cheios (chats ociosos)
+                self._chats = {k: v for k, v in self._chats.items() if not v.ocioso()}
+            b = self._chats[chat_id] = _Balde(ENVIO_CHAT_POR_MIN / 60, ENVIO_CHAT_RAJADA)
+        return b
+
+    async def _vez_global(self, prioridade):
+        fut = self._loop.create_future()
+        heapq.heappush(self._fila, (prioridade, next(self._seq), fut))
+        if self._bomba is None or self._bomba.done():
+            self._bomba = self._loop.create_task(self._bombear())
+        await fut
+
+    async def _bombear(self):
+        while self._fila:
+            t = self._global.espera()
+            if t > 0:
+                await asyncio.sleep(t); continue
+            _, _, fut = heapq.heappop(self._fila)
+            if fut.done(): self._global.fichas += 1   # quem esperava desistiu: devolve a ficha
+            else: fut.set_result(None)
+
+    async def executar(self, chat_id, fn, prioridade=PRIO_INTERATIVO):
+        """Espera a vez e executa `fn()` (coroutine que faz a chamada ao Telegram)."""
+        self._preparar()
+        balde = self._balde_chat(chat_id)
+        for tentativa in range(ENVIO_TENTATIVAS):
+            while (t := balde.espera()) > 0:
+                await asyncio.sleep(t)
+            await self._vez_global(prioridade)
+            inicio = time.monotonic()
+            try:
+                res = await fn()
+            except RetryAfter as e:
+                metricas.contar("streamflix_telegram_envios_total", resultado="retry_after")
+                ra = e.retry_after
+                segs = ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+                logging.warning(f"Flood control em {chat_id}: aguardando {segs:.0f}s")
+                balde.pausa_ate = time.monotonic() + segs + 1
+                if tentativa + 1 == ENVIO_TENTATIVAS: raise
+            except Exception:
+                metricas.contar("streamflix_telegram_envios_total", resultado="falha"); raise
+            else:
+                metricas.observar("streamflix_telegram_segundos", time.monotonic() - inicio)
+                metricas.contar("streamflix_telegram_envios_total", resultado="ok")
+                return res
+
+envios = AgendadorEnvio()
 
 # ── Envio ──────────────────────────────────────────────────────────────────
-async def enviar(context, chat_id, text=None, photo=None, caption=None, markup=None, parse_mode="HTML"):
+async def enviar(context, chat_id, text=None, photo=None, caption=None, markup=None,
+                 parse_mode="HTML", prioridade=PRIO_INTERATIVO, photo_reserva=None):
+    """`photo_reserva`: tentada no mesmo tópico se a foto for recusada (ex.: file_id vencido → URL)."""
+    try: await get_cliente_async(chat_id)
+    except Exception: pass
     topic = get_topic_id(chat_id)
     kw = {"parse_mode": parse_mode}
     if topic:  kw["message_thread_id"] = topic
     if markup: kw["reply_markup"] = markup
-    try:
+    async def _mandar():
         if photo:  return await context.bot.send_photo(chat_id, photo, caption=caption, **kw)
         elif text: return await context.bot.send_message(chat_id, text, **kw)
+    try:
+        return await envios.executar(chat_id, _mandar, prioridade)
+    except RetryAfter as e:
+        logging.error(f"Envio {chat_id}: flood control persistente ({e})"); return None
     except Exception as e:
-        logging.error(f"Envio: {e}")
-        kw.pop("message_thread_id", None)
+        erro = e
+    if photo_reserva and photo != photo_reserva:
+        # Primeiro troca só a foto: o tópico continua valendo, quem falhou foi o file_id
+        logging.warning(f"Envio {chat_id}: foto recusada ({erro}), tentando a reserva")
+        photo = photo_reserva
         try:
-            if photo:  return await context.bot.send_photo(chat_id, photo, caption=caption, **kw)
-            elif text: return await context.bot.send_message(chat_id, text, **kw)
-        except Exception as e2: logging.error(f"Fallback: {e2}")
+            return await envios.executar(chat_id, _mandar, prioridade)
+        except RetryAfter as e:
+            logging.error(f"Envio {chat_id}: flood control persistente ({e})"); return None
+        except Exception as e:
+            erro = e
+    logging.error(f"Envio: {erro}")
+    kw.pop("message_thread_id", None)
+    try:
+        return await envios.executar(chat_id, _mandar, prioridade)
+    except Exception as e2: logging.error(f"Fallback: {e2}")
+
+_posters = CacheTTL(7 * 86400, maxsize=4096, nome="posters")   # poster_path → file_id no Telegram
 
-async def send_item(context, chat_id, item, is_tv=False, tipo="movie"):
+async def send_item(context, chat_id, item, is_tv=False, tipo="movie", details=None,
+                    prioridade=PRIO_INTERATIVO):
     if not item: return
-    iid     = item.get("id")
-    details = tmdb_details(iid, is_tv=is_tv) or item
-    title   = details.get("name") if is_tv else details.get("title","?")
-    caption = build_caption(details, is_tv=is_tv)
-    modo     = get_modo(chat_id)
-    site     = get_site_url(chat_id)
-    # modo 'completo': botão site personalizado; modo 'simples': só assistir
-    if modo == "simples":
-        keyboard = [
-            [InlineKeyboardButton("▶️ ASSISTIR AGORA", url=link_streamflix(iid, is_tv=is_tv))]
-        ]
-    else:
-        keyboard = [
-            [InlineKeyboardButton("▶️ ASSISTIR AGORA",    url=link_streamflix(iid, is_tv=is_tv))],
-            [InlineKeyboardButton("🌐 Visite nosso Site", url=site)]
-        ]
+    iid      = item.get("id")
+    details  = details or await tmdb_details(iid, is_tv=is_tv)
+    do_tmdb  = details is not None   # sem os detalhes do TMDB a legenda sai do item da lista: não vai pro cache
+    details  = details or item
+    title    = details.get("name") if is_tv else details.get("title","?")
+    try: await get_cliente_async(chat_id)
+    except Exception: pass
+    entrega = get_entrega(chat_id)
+    # Fora do modo 'separado' o trailer vai junto da foto: metade dos envios por item
+    trailer = await get_trailer_url(details, title, is_tv=is_tv) if entrega != "separado" else None
+    caption, markup = renderizar_item(iid, details, is_tv, get_modo(chat_id), get_site_url(chat_id),
+                                      entrega, trailer, cachear=do_tmdb)
     post = details.get("poster_path") or item.get("poster_path")
     try:
-        if post: await enviar(context, chat_id, photo=f"{IMG_BASE}{post}", caption=caption, markup=InlineKeyboardMarkup(keyboard))
-        else:    await enviar(context, chat_id, text=caption, markup=InlineKeyboardMarkup(keyboard))
-        await enviar(context, chat_id, text=f"🎬 <b>Confira o Trailer:</b>\n{get_trailer_url(iid, title, is_tv=is_tv)}")
-        marcar_enviado(chat_id, iid, tipo)
-    except Exception as e: logging.error(e)
+        if post:
+            # Depois do primeiro envio o Telegram já tem o pôster: reusa o file_id em vez da URL do TMDB
+            url    = f"{IMG_BASE}{post}"
+            em_uso = _posters.get(post)
+            msg = await enviar(context, chat_id, photo=em_uso or url, caption=caption,
+                               markup=markup, prioridade=prioridade, photo_reserva=url)
+            if msg is not None and msg.photo:
+                _posters.set(post, msg.photo[-1].file_id)
+            elif em_uso:
+                _posters.invalidar(post)   # file_id recusado: o próximo envio volta pra URL
+        else:
+            msg = await enviar(context, chat_id, text=caption, markup=markup, prioridade=prioridade)
+        if msg is None: return False
+    except Exception as e:
+        logging.error(e); return False
+    # A foto já saiu: o item conta como entregue mesmo se o trailer falhar (reenviar duplicaria o post)
+    try:
+        if marcar_enviado(chat_id, iid, tipo):
+            await no_banco(flush_enviados)
+        if entrega == "separado":
+            trailer = await get_trailer_url(details, title, is_tv=is_tv)
+            if await enviar(context, chat_id, text=f"🎬 <b>Confira o Trailer:</b>\n{trailer}",
+                            prioridade=prioridade) is None:
+                logging.warning(f"Trailer de {iid} não chegou em {chat_id}")
+    except Exception as e:
+        logging.error(f"Pós-envio {chat_id}: {e}")
+    return True
 
 async def enviar_lista(context, chat_id, itens, is_tv=False, tipo="movie", limite=3):
-    itens = filtrar(chat_id, itens, tipo)
+    itens = await no_banco(filtrar, chat_id, itens, tipo)
     random.shuffle(itens)
     for item in itens[:limite]:
         await send_item(context, chat_id, item, is_tv=is_tv, tipo=tipo)
 
+BROADCAST_CONCORRENCIA = int(os.environ.get("BROADCAST_CONCORRENCIA", "10"))  # chats atendidos ao mesmo tempo
+
+async def disparar(chats, entregar, rotulo="Disparo", concorrencia=BROADCAST_CONCORRENCIA):
+    """Roda `entregar(chat_id)` para cada chat com concorrência limitada.
+
+    Cada chat é processado em sequência internamente; falhas de um chat não
+    afetam os outros. Retorna (ok, falhas).
+    """
+    sem = asyncio.Semaphore(concorrencia)
+    async def um(cid):
+        async with sem:
+            try:
+                await entregar(cid); return True
+            except Exception as e:
+                logging.error(f"{rotulo} → {cid}: {e}"); return False
+    res = await asyncio.gather(*(um(cid) for cid in chats))
+    return sum(res), len(res) - sum(res)
+
+# ── Outbox (entregas agendadas duráveis) ──────────────────────────────────
+OUTBOX_TENTATIVAS = 3
+OUTBOX_VALIDADE_H = 12   # pendência mais velha que isso já perdeu o sentido e expira
+
+def outbox_planejar(lote, planos):
+    """Grava as entregas de um lote; `planos` = {chat_id: [payload, ...]} em ordem.
+
+    A chave lote:chat:seq torna a gravação idempotente.
+    """
+    linhas = [(f"{lote}:{cid}:{seq}", lote, cid, Json(p))
+              for cid, payloads in planos.items() for seq, p in enumerate(payloads)]
+    with db() as cur:
+        execute_values(cur, """INSERT INTO outbox(chave, lote, chat_id, payload) VALUES %s
+            ON CONFLICT (chave) DO NOTHING""", linhas, page_size=500)
+
+def outbox_lote_existe(lote):
+    with db() as cur:
+        cur.execute("SELECT 1 FROM outbox WHERE lote=%s LIMIT 1", (lote,))
+        return cur.fetchone() is not None
+
+def outbox_pendentes():
+    """Pendências agrupadas por chat, na ordem em que foram planejadas."""
+    with db() as cur:
+        cur.execute("""UPDATE outbox SET status='expired', atualizado=NOW()
+            WHERE status='pending' AND criado_em < NOW() - %s * INTERVAL '1 hour'""", (OUTBOX_VALIDADE_H,))
+        cur.execute("SELECT id, chat_id, payload FROM outbox WHERE status='pending' ORDER BY id")
+        rows = cur.fetchall()
+    por_chat = {}
+    for oid, cid, payload in rows:
+        por_chat.setdefault(cid, []).append((oid, payload))
+    return por_chat
+
+def outbox_reservar(ids):
+    """Marca como 'sending' antes de enviar; só o que for reservado aqui pode ser enviado."""
+    with db() as cur:
+        cur.execute("""UPDATE outbox SET status='sending', tentativas=tentativas+1, atualizado=NOW()
+            WHERE id = ANY(%s) AND status='pending' RETURNING id""", (ids,))
+        return {r[0] for r in cur.fetchall()}
+
+def outbox_concluir(enviados, falhos):
+    with db() as cur:
+        if enviados:
+            cur.execute("UPDATE outbox SET status='sent', atualizado=NOW() WHERE id = ANY(%s)", (enviados,))
+        if falhos:
+            cur.execute("""UPDATE outbox SET atualizado=NOW(),
+                status=CASE WHEN tentativas >= %s THEN 'failed' ELSE 'pending' END
+                WHERE id = ANY(%s)""", (OUTBOX_TENTATIVAS, falhos))
+
+def outbox_recuperar():
+    """Na subida: o que ficou 'sending' num processo que morreu pode ter sido entregue.
+
+    Para não duplicar, essas entregas não são repetidas (status 'unknown').
+    """
+    try:
+        with db() as cur:
+            cur.execute("UPDATE outbox SET status='unknown', atualizado=NOW() WHERE status='sending'")
+            if cur.rowcount: logging.warning(f"Outbox: {cur.rowcount} entregas interrompidas marcadas como 'unknown'")
+    except Exception as e: logging.error(f"Outbox (recuperação): {e}")
+
+_outbox_rodando = False
+_outbox_de_novo = False
+
+async def processar_outbox(context):
+    """Entrega as pendências da outbox. Chamadas simultâneas viram mais uma passada."""
+    global _outbox_rodando, _outbox_de_novo
+    if _outbox_rodando:
+        _outbox_de_novo = True; return
+    _outbox_rodando = True
+    try:
+        while True:
+            _outbox_de_novo = False
+            await _processar_outbox(context)
+            if not _outbox_de_novo: break
+    finally:
+        _outbox_rodando = False
+
+async def _processar_outbox(context):
+    try: por_chat = await no_banco(outbox_pendentes)
+    except Exception as e:
+        logging.error(f"Outbox: {e}"); return
+    if not por_chat: return
+    inicio = time.monotonic()
+
+    # Detalhes uma única vez por título, para todos os chats
+    chaves   = list({(p["item"]["id"], p["is_tv"]) for fila in por_chat.values()
+                     for _, p in fila if p["tipo"] == "item"})
+    detalhes = dict(zip(chaves, await asyncio.gather(*(tmdb_details(iid, is_tv=tv) for iid, tv in chaves))))
+
+    async def entregar(cid):
+        # Reserva e conclui uma linha por vez: se o processo cair, só a mensagem
+        # que estava realmente em voo fica 'sending' (e vira 'unknown' na subida)
+        for oid, p in por_chat[cid]:
+            if not await no_banco(outbox_reservar, [oid]): continue
+            ok = False
+            try:
+                if p["tipo"] == "texto":
+                    ok = await enviar(context, cid, text=p["text"], prioridade=PRIO_BROADCAST) is not None
+                else:
+                    ok = await send_item(context, cid, p["item"], is_tv=p["is_tv"], tipo=p["tipo_item"],
+                                         details=detalhes.get((p["item"]["id"], p["is_tv"])),
+                                         prioridade=PRIO_BROADCAST)
+            finally:
+                await no_banco(outbox_concluir, [oid] if ok else [], [] if ok else [oid])
+
+    ok, falhas = await disparar(list(por_chat), entregar, rotulo="Outbox")
+    await no_banco(flush_enviados)
+    logging.info(f"Outbox: {ok} chats ok, {falhas} falhas em {time.monotonic()-inicio:.1f}s")
+
+@medir_job
+async def job_outbox(context: ContextTypes.DEFAULT_TYPE):
+    await processar_outbox(context)
+
 # ── Verificação de acesso ──────────────────────────────────────────────────
 async def verificar_acesso(update: Update, context) -> bool:
     cid = update.effective_chat.id
-    if cliente_ativo(cid): return True
+    if await cliente_ativo_async(cid): return True
     await update.message.reply_text(
         "🔒 <b>Acesso bloqueado!</b>\n\n"
         "Seu plano não está ativo ou expirou.\n\n"
@@ -1236,7 +2137,7 @@ async def verificar_acesso(update: Update, context) -> bool:
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid  = update.effective_chat.id
     user = update.effective_user
-    if not cliente_ativo(cid):
+    if not await cliente_ativo_async(cid):
         bot_info = await context.bot.get_me()
         bot_username = bot_info.username
         await update.message.reply_text(
@@ -1285,12 +2186,12 @@ async def cmd_ativar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Use: <code>/ativar SEU_TOKEN</code>", parse_mode="HTML")
         return
     token = context.args[0].strip().upper()
-    if not token_valido(token):
+    if not await no_banco(token_valido, token):
         await update.message.reply_text(
             "❌ Token inválido ou já utilizado.\n\nAdquira um novo em: " + CANAL_SUPORTE)
         return
     topic    = int(context.args[1]) if len(context.args) > 1 else 0
-    validade = usar_token(token, cid, topic)
+    validade = await no_banco(usar_token, token, cid, topic)
     if validade:
         await update.message.reply_text(
             f"✅ <b>Bot ativado com sucesso!</b>\n\n"
@@ -1323,15 +2224,12 @@ async def cmd_ativar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_meuplan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
-    try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT ativo, validade FROM clientes WHERE chat_id=%s", (cid,))
-        r = cur.fetchone(); cur.close(); c.close()
-    except: r = None
-    if not r:
+    try: cfg = await get_cliente_async(cid)
+    except: cfg = None
+    if not cfg:
         await update.message.reply_text(f"❌ Sem plano ativo.\nAdquira em: {CANAL_SUPORTE}")
         return
-    ativo, validade = r
+    ativo, validade = cfg["ativo"], cfg["validade"]
     dias_rest = (validade - datetime.utcnow()).days if validade else 0
     status    = "✅ Ativo" if (ativo and dias_rest > 0) else "❌ Expirado"
     await update.message.reply_text(
@@ -1351,7 +2249,7 @@ async def cmd_gerar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
         await update.message.reply_text("⛔ Acesso negado."); return
     qtd    = min(int(context.args[0]) if context.args else 1, 10)
-    tokens = [gerar_token() for _ in range(qtd)]
+    tokens = [await no_banco(gerar_token) for _ in range(qtd)]
     msg    = f"🎟️ <b>{qtd} Token(s) gerado(s) — 30 dias:</b>\n\n"
     for t in tokens: msg += f"<code>{t}</code>\n"
     msg += f"\n📲 Cliente usa: <code>/ativar TOKEN</code>"
@@ -1360,14 +2258,14 @@ async def cmd_gerar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_clientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
         await update.message.reply_text("⛔ Acesso negado."); return
-    rows = listar_clientes()
+    rows = await no_banco(listar_clientes)
     if not rows:
         await update.message.reply_text("📭 Nenhum cliente cadastrado."); return
-    try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT chat_id, modo, site_url FROM clientes")
-        extras = {r[0]: (r[1] or "completo", r[2]) for r in cur.fetchall()}
-        cur.close(); c.close()
+    def _extras():
+        with db() as cur:
+            cur.execute("SELECT chat_id, modo, site_url FROM clientes")
+            return {r[0]: (r[1] or "completo", r[2]) for r in cur.fetchall()}
+    try: extras = await no_banco(_extras)
     except: extras = {}
     msg = f"👥 <b>Clientes ({len(rows)}):</b>\n\n"
     for chat_id, ativo, validade, criado in rows:
@@ -1386,7 +2284,7 @@ async def cmd_renovar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("⚠️ Use: /renovar CHAT_ID"); return
     cid  = int(context.args[0])
-    nova = renovar_cliente(cid)
+    nova = await no_banco(renovar_cliente, cid)
     if nova:
         await update.message.reply_text(
             f"✅ Cliente <code>{cid}</code> renovado!\nNova validade: <b>{nova.strftime('%d/%m/%Y')}</b>",
@@ -1405,7 +2303,7 @@ async def cmd_revogar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("⚠️ Use: /revogar CHAT_ID"); return
     cid = int(context.args[0])
-    if revogar_cliente(cid):
+    if await no_banco(revogar_cliente, cid):
         await update.message.reply_text(f"✅ Acesso de <code>{cid}</code> revogado.", parse_mode="HTML")
         try:
             await context.bot.send_message(cid,
@@ -1417,15 +2315,7 @@ async def cmd_revogar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
         await update.message.reply_text("⛔ Acesso negado."); return
-    try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT COUNT(*) FROM clientes WHERE ativo=TRUE AND validade > NOW()")
-        ativos = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM clientes WHERE ativo=FALSE OR validade <= NOW()")
-        inativos = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM tokens WHERE usado=FALSE")
-        tokens_livres = cur.fetchone()[0]
-        cur.close(); c.close()
+    try: ativos, inativos, tokens_livres = await no_banco(contar_clientes)
     except: ativos = inativos = tokens_livres = 0
     await update.message.reply_text(
         f"📊 <b>Painel StreamFlix:</b>\n\n"
@@ -1450,7 +2340,11 @@ async def cmd_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "<code>/config CHAT_ID modo simples</code>  — só botão assistir\n\n"
             "<b>Site personalizado do cliente:</b>\n"
             "<code>/config CHAT_ID site https://sitedomeucliente.com</code>\n"
-            "<code>/config CHAT_ID site remover</code> — volta ao padrão",
+            "<code>/config CHAT_ID site remover</code> — volta ao padrão\n\n"
+            "<b>Entrega do trailer:</b>\n"
+            "<code>/config CHAT_ID entrega separado</code> — foto + mensagem do trailer\n"
+            "<code>/config CHAT_ID entrega botao</code>    — trailer como botão na foto\n"
+            "<code>/config CHAT_ID entrega legenda</code>  — link do trailer na legenda",
             parse_mode="HTML"); return
     try: cid = int(context.args[0])
     except:
@@ -1461,7 +2355,7 @@ async def cmd_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if acao == "modo":
         if valor not in ("simples", "completo"):
             await update.message.reply_text("❌ Modo inválido. Use <code>simples</code> ou <code>completo</code>.", parse_mode="HTML"); return
-        if set_modo(cid, valor):
+        if await no_banco(set_modo, cid, valor):
             icone = "📋" if valor == "simples" else "🌐"
             await update.message.reply_text(
                 f"✅ <b>Modo atualizado!</b>\n{icone} Chat <code>{cid}</code> → modo <b>{valor}</b>",
@@ -1471,12 +2365,12 @@ async def cmd_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif acao == "site":
         if valor.lower() == "remover":
-            set_site_url(cid, None)
+            await no_banco(set_site_url, cid, None)
             await update.message.reply_text(
                 f"✅ Site removido! Chat <code>{cid}</code> voltou ao padrão (<code>{SITE_URL}</code>)",
                 parse_mode="HTML")
         elif valor.startswith("http"):
-            if set_site_url(cid, valor):
+            if await no_banco(set_site_url, cid, valor):
                 await update.message.reply_text(
                     f"✅ <b>Site atualizado!</b>\n🔗 Chat <code>{cid}</code> → <code>{valor}</code>",
                     parse_mode="HTML")
@@ -1484,11 +2378,25 @@ async def cmd_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(f"❌ Chat ID <code>{cid}</code> não encontrado.", parse_mode="HTML")
         else:
             await update.message.reply_text("❌ URL inválida. Deve começar com <code>http</code>.", parse_mode="HTML")
+
+    elif acao == "entrega":
+        valor = valor.lower()
+        if valor not in ENTREGAS:
+            await update.message.reply_text(
+                "❌ Entrega inválida. Use <code>separado</code>, <code>botao</code> ou <code>legenda</code>.",
+                parse_mode="HTML"); return
+        if await no_banco(set_entrega, cid, valor):
+            await update.message.reply_text(
+                f"✅ <b>Entrega atualizada!</b>\n🎬 Chat <code>{cid}</code> → <b>{valor}</b>",
+                parse_mode="HTML")
+        else:
+            await update.message.reply_text(f"❌ Chat ID <code>{cid}</code> não encontrado.", parse_mode="HTML")
     else:
-        await update.message.reply_text("❌ Ação inválida. Use <code>modo</code> ou <code>site</code>.", parse_mode="HTML")
+        await update.message.reply_text("❌ Ação inválida. Use <code>modo</code>, <code>site</code> ou <code>entrega</code>.", parse_mode="HTML")
 
 
 
+@medir_job
 async def job_propaganda(context: ContextTypes.DEFAULT_TYPE):
     """Roda 3x ao dia: posta propaganda rotativa nos canais principais."""
     canais = []
@@ -1497,9 +2405,9 @@ async def job_propaganda(context: ContextTypes.DEFAULT_TYPE):
     if not canais: return
 
     # Pega propagandas do banco; usa as fixas como fallback
-    custom = get_propagandas()
+    custom = await no_banco(get_propagandas)
     todas = custom if custom else PROPAGANDAS_FIXAS
-    idx = get_proximo_idx() % len(todas)
+    idx = await no_banco(get_proximo_idx) % len(todas)
     texto = todas[idx].format(contato=ADMIN_CONTATO)
 
     for cid in canais:
@@ -1507,12 +2415,12 @@ async def job_propaganda(context: ContextTypes.DEFAULT_TYPE):
             kw = {}
             if cid == GRUPO_ID and TOPIC_ID:
                 kw["message_thread_id"] = TOPIC_ID
-            await context.bot.send_message(
+            await envios.executar(cid, lambda cid=cid, kw=kw: context.bot.send_message(
                 chat_id=cid, text=texto, parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup([[
                     InlineKeyboardButton("💬 Falar com Admin", url=f"https://t.me/{ADMIN_CONTATO.lstrip('@')}")
                 ]]), **kw
-            )
+            ), PRIO_BROADCAST)
         except Exception as e: logging.error(f"Propaganda {cid}: {e}")
 
 async def enviar_propaganda_agora(context, texto_custom=None):
@@ -1525,67 +2433,108 @@ async def enviar_propaganda_agora(context, texto_custom=None):
     enviados = 0
     for cid in canais:
         try:
-            await context.bot.send_message(
+            await envios.executar(cid, lambda cid=cid: context.bot.send_message(
                 chat_id=cid, text=texto, parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup([[
                     InlineKeyboardButton("💬 Falar com Admin", url=f"https://t.me/{ADMIN_CONTATO.lstrip('@')}")
                 ]])
-            )
+            ), PRIO_BROADCAST)
             enviados += 1
         except Exception as e: logging.error(f"Propaganda manual {cid}: {e}")
     return enviados
 
+@medir_job
 async def job_verificar_vencimentos(context: ContextTypes.DEFAULT_TYPE):
-    """Roda a cada hora: avisa quem vence em 3 dias e bloqueia quem venceu."""
-    for cid in clientes_para_avisar():
-        try:
-            await context.bot.send_message(cid,
-                f"⚠️ <b>Seu plano vence em 3 dias!</b>\n\n"
-                f"Renove agora para continuar assistindo:\n{CANAL_SUPORTE}",
-                parse_mode="HTML")
-            marcar_aviso_3d(cid)
-            await context.bot.send_message(ADMIN_ID,
-                f"🟡 Aviso enviado → <code>{cid}</code> (vence em 3 dias)", parse_mode="HTML")
-        except Exception as e: logging.error(f"Aviso 3d {cid}: {e}")
+    """Roda a cada hora: avisa quem vence em 3 dias e bloqueia quem venceu.
+
+    Cada transição é um UPDATE … RETURNING (marca antes de avisar: no máximo um
+    aviso por cliente); as mensagens saem em lote pelo disparar e o admin recebe um resumo.
+    Aviso de 3 dias que falhou é desmarcado e volta na próxima hora.
+    """
+    bot = context.bot
+    try:
+        avisar   = await no_banco(marcar_avisos_3d)
+        vencidos = await no_banco(marcar_vencidos)
+    except Exception as e:
+        logging.error(f"job_verificar_vencimentos: {e}"); return
+    if not avisar and not vencidos: return
 
-    for cid in clientes_vencidos():
+    def mensagem(texto, falhos=None):
+        async def entregar(cid):
+            try:
+                await envios.executar(cid, lambda: bot.send_message(cid, texto, parse_mode="HTML"), PRIO_BROADCAST)
+            except Exception:
+                if falhos is not None: falhos.append(cid)
+                raise
+        return entregar
+
+    resumo = []
+    if avisar:
+        falhos = []
+        ok, falhas = await disparar(avisar, mensagem(
+            f"⚠️ <b>Seu plano vence em 3 dias!</b>\n\n"
+            f"Renove agora para continuar assistindo:\n{CANAL_SUPORTE}", falhos), rotulo="Aviso 3d")
+        try: await no_banco(desmarcar_avisos_3d, falhos)
+        except Exception as e: logging.error(f"Desmarcar aviso 3d: {e}")
+        resumo.append(f"🟡 Aviso de 3 dias: <b>{ok}</b> enviados, {falhas} falhas\n"
+                      + ", ".join(f"<code>{c}</code>" for c in avisar[:50]))
+    if vencidos:
+        ok, falhas = await disparar(vencidos, mensagem(
+            f"🔴 <b>Seu plano expirou!</b>\n\n"
+            f"O bot foi suspenso automaticamente.\n\n"
+            f"Para renovar e reativar:\n{CANAL_SUPORTE}"), rotulo="Bloqueio")
+        resumo.append(f"🔴 Bloqueados (plano vencido): <b>{len(vencidos)}</b> ({falhas} sem aviso)\n"
+                      + ", ".join(f"<code>{c}</code>" for c in vencidos[:50]))
+    if ADMIN_ID:
         try:
-            marcar_vencido(cid)
-            await context.bot.send_message(cid,
-                f"🔴 <b>Seu plano expirou!</b>\n\n"
-                f"O bot foi suspenso automaticamente.\n\n"
-                f"Para renovar e reativar:\n{CANAL_SUPORTE}",
-                parse_mode="HTML")
-            await context.bot.send_message(ADMIN_ID,
-                f"🔴 Cliente <code>{cid}</code> bloqueado automaticamente (plano vencido).", parse_mode="HTML")
-        except Exception as e: logging.error(f"Bloqueio {cid}: {e}")
+            await envios.executar(ADMIN_ID, lambda: bot.send_message(ADMIN_ID, "\n\n".join(resumo),
+                                                                     parse_mode="HTML"), PRIO_BROADCAST)
+        except Exception as e: logging.error(f"Resumo de vencimentos: {e}")
 
+@medir_job
 async def job_diario_todos(context: ContextTypes.DEFAULT_TYPE, turno="manha"):
-    """Posta conteúdo para TODOS os clientes ativos."""
-    try:
-        c = db(); cur = c.cursor()
-        cur.execute("SELECT chat_id FROM clientes WHERE ativo=TRUE AND validade > NOW()")
-        chats = [r[0] for r in cur.fetchall()]; cur.close(); c.close()
-    except: chats = []
-    if GRUPO_ID and GRUPO_ID not in chats: chats.append(GRUPO_ID)
-    if CANAL_VIP and CANAL_VIP not in chats: chats.append(CANAL_VIP)
-
+    """Posta conteúdo para TODOS os clientes ativos.
+
+    A lista do TMDB é buscada uma vez só, a seleção de cada chat vira um lote
+    na outbox e processar_outbox faz as entregas. Se o processo cair no meio,
+    o lote não é replanejado e as pendências são retomadas na subida.
+    """
+    lote = f"{datetime.utcnow():%Y-%m-%d}:{turno}"
+    if await no_banco(outbox_lote_existe, lote):
+        logging.info(f"Job {turno}: lote {lote} já planejado, só retomando pendências")
+        await processar_outbox(context); return
+    chats = await no_banco(chats_ativos)
+    if not chats: return
+
+    if turno == "manha":
+        d = await tmdb("movie/now_playing", {"region":"BR"})
+        cabecalho  = "🌅 <b>Bom dia! Confira o que está em cartaz hoje:</b>"
+        candidatos = d.get("results",[]) if d else []
+    else:
+        d = await tmdb("trending/all/week")
+        cabecalho  = "🌆 <b>Boa noite! Top da semana para você:</b>"
+        candidatos = d.get("results",[])[:6] if d else []
+    if not candidatos:
+        logging.warning(f"Job {turno}: TMDB sem resultados"); return
+
+    # Seleção por chat (respeitando sent_items no turno da manhã, numa consulta só)
+    enviados = await no_banco(ja_enviados_lote, chats, "now_playing") if turno == "manha" else {}
+    planos = {}
     for cid in chats:
-        try:
-            if turno == "manha":
-                d = tmdb("movie/now_playing", {"region":"BR"})
-                if d:
-                    await enviar(context, cid, text="🌅 <b>Bom dia! Confira o que está em cartaz hoje:</b>")
-                    await enviar_lista(context, cid, d.get("results",[]), tipo="now_playing", limite=2)
-            else:
-                d = tmdb("trending/all/week")
-                if d:
-                    await enviar(context, cid, text="🌆 <b>Boa noite! Top da semana para você:</b>")
-                    itens = d.get("results",[])[:6]; random.shuffle(itens)
-                    for item in itens[:2]:
-                        is_tv = item.get("media_type") == "tv"
-                        await send_item(context, cid, item, is_tv=is_tv, tipo="tv" if is_tv else "movie")
-        except Exception as e: logging.error(f"Job {turno} → {cid}: {e}")
+        itens = (filtrar(cid, candidatos, "now_playing", enviados[cid]) if turno == "manha"
+                 else list(candidatos))
+        random.shuffle(itens)
+        entregas = [{"tipo": "texto", "text": cabecalho}]
+        for item in itens[:2]:
+            is_tv = item.get("media_type") == "tv"
+            entregas.append({
+                "tipo": "item", "is_tv": is_tv,
+                "tipo_item": "now_playing" if turno == "manha" else ("tv" if is_tv else "movie"),
+                "item": {k: item.get(k) for k in ("id", "media_type", "poster_path", "title", "name")},
+            })
+        planos[cid] = entregas
+    await no_banco(outbox_planejar, lote, planos)
+    await processar_outbox(context)
 
 async def job_diario_manha(context): await job_diario_todos(context, "manha")
 async def job_diario_noite(context): await job_diario_todos(context, "noite")
@@ -1597,23 +2546,23 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
 
     if text == "🎥 Em Cartaz":
-        d = tmdb("movie/now_playing", {"region":"BR"})
+        d = await tmdb("movie/now_playing", {"region":"BR"})
         if d: await enviar_lista(context, cid, d.get("results",[]), tipo="now_playing")
 
     elif text == "🚀 Em Breve":
-        d = tmdb("movie/upcoming", {"region":"BR"})
+        d = await tmdb("movie/upcoming", {"region":"BR"})
         if d: await enviar_lista(context, cid, d.get("results",[]), tipo="upcoming")
 
     elif text == "🌟 Populares":
-        d = tmdb("movie/popular", {"region":"BR","page":random.randint(1,5)})
+        d = await tmdb("movie/popular", {"region":"BR","page":random.randint(1,5)})
         if d: await enviar_lista(context, cid, d.get("results",[]))
 
     elif text == "📺 Séries":
-        d = tmdb("tv/popular", {"page":random.randint(1,5)})
+        d = await tmdb("tv/popular", {"page":random.randint(1,5)})
         if d: await enviar_lista(context, cid, d.get("results",[]), is_tv=True, tipo="tv")
 
     elif text == "🔥 Em Alta":
-        d = tmdb("trending/all/week")
+        d = await tmdb("trending/all/week")
         if d:
             for item in d.get("results",[])[:4]:
                 is_tv = item.get("media_type") == "tv"
@@ -1628,7 +2577,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await enviar(context, cid, text="⏳ <b>Escolha uma Época:</b>", markup=InlineKeyboardMarkup(btns))
 
     elif text == "🎲 Sugestão":
-        d = tmdb("movie/top_rated", {"page":random.randint(1,20)})
+        d = await tmdb("movie/top_rated", {"page":random.randint(1,20)})
         if d and d.get("results"): await enviar_lista(context, cid, d["results"], limite=1)
 
     elif text == "🔍 Buscar":
@@ -1646,20 +2595,20 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def callback_handler(update, context):
     q   = update.callback_query; await q.answer()
     cid = update.effective_chat.id
-    if not cliente_ativo(cid):
+    if not await cliente_ativo_async(cid):
         await q.message.reply_text(f"🔒 Acesso bloqueado. Renove em: {CANAL_SUPORTE}"); return
     data = q.data
 
     if data.startswith("gen_"):
         gid = data.split("_")[1]
-        d = tmdb("discover/movie", {"with_genres":gid,"sort_by":"popularity.desc","page":random.randint(1,5)})
+        d = await tmdb("discover/movie", {"with_genres":gid,"sort_by":"popularity.desc","page":random.randint(1,5)})
         if d and d.get("results"): await enviar_lista(context, cid, d["results"])
 
     elif data.startswith("era_"):
         era = data.split("_",1)[1]
         inicio, fim = EPOCAS[era]
         ano = random.randint(inicio, fim)
-        d = tmdb("discover/movie", {"primary_release_year":ano,"sort_by":"popularity.desc","page":1})
+        d = await tmdb("discover/movie", {"primary_release_year":ano,"sort_by":"popularity.desc","page":1})
         if d and d.get("results"):
             await enviar(context, cid, text=f"🎞️ <b>Melhores de {ano}...</b>")
             await enviar_lista(context, cid, d["results"][:10])
@@ -1671,7 +2620,7 @@ async def cmd_filme(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Use: /filme Nome do Filme"); return
     cid = update.effective_chat.id
     q   = " ".join(context.args)
-    d   = tmdb("search/movie", {"query": q})
+    d   = await tmdb("search/movie", {"query": q})
     res = d.get("results",[]) if d else []
     if not res:
         await enviar(context, cid, text=f"😕 Filme não encontrado: <b>{html.escape(q)}</b>"); return
@@ -1683,7 +2632,7 @@ async def cmd_serie(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Use: /serie Nome da Série"); return
     cid = update.effective_chat.id
     q   = " ".join(context.args)
-    d   = tmdb("search/tv", {"query": q})
+    d   = await tmdb("search/tv", {"query": q})
     res = d.get("results",[]) if d else []
     if not res:
         await enviar(context, cid, text=f"😕 Série não encontrada: <b>{html.escape(q)}</b>"); return
@@ -1695,12 +2644,12 @@ async def cmd_ator(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Use: /ator Nome do Ator"); return
     cid = update.effective_chat.id
     q   = " ".join(context.args)
-    d   = tmdb("search/person", {"query": q})
+    d   = await tmdb("search/person", {"query": q})
     pessoas = d.get("results",[]) if d else []
     if not pessoas:
         await enviar(context, cid, text=f"😕 Ator não encontrado: <b>{html.escape(q)}</b>"); return
     pessoa   = pessoas[0]; nome = pessoa.get("name",""); pid = pessoa.get("id")
-    filmes_d = tmdb(f"person/{pid}/movie_credits")
+    filmes_d = await tmdb(f"person/{pid}/movie_credits")
     filmes   = sorted(filmes_d.get("cast",[]) if filmes_d else [], key=lambda x: x.get("popularity",0), reverse=True)
     if not filmes:
         await enviar(context, cid, text=f"😕 Nenhum filme encontrado para <b>{html.escape(nome)}</b>"); return
@@ -1710,7 +2659,7 @@ async def cmd_ator(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_top10(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await verificar_acesso(update, context): return
     cid = update.effective_chat.id
-    d   = tmdb("trending/all/week")
+    d   = await tmdb("trending/all/week")
     if not d or not d.get("results"):
         await enviar(context, cid, text="😕 Não foi possível buscar o Top 10."); return
     itens  = d["results"][:10]
@@ -1747,11 +2696,384 @@ async def cmd_ajuda(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await verificar_acesso(update, context): return
     await cmd_ajuda_fn(context, update.effective_chat.id)
 
+# ── Pagamentos (webhook Mercado Pago) ──────────────────────────────────────
+PAGAMENTOS_WORKERS = 4   # verificações simultâneas na API do MP
+MP_STATUS_FINAIS   = {"approved", "rejected", "cancelled", "refunded", "charged_back"}
+
+_pagamentos_fila    = None    # asyncio.Queue do loop do bot
+_pagamentos_tarefas = []
+_pagamentos_na_fila = set()   # ids aguardando o worker: webhooks repetidos viram no-op
+_pagamentos_lock    = threading.Lock()
+_pagamentos_vistos  = CacheTTL(3600, maxsize=4096, nome="pagamentos")   # ids já em status final
+
+def enfileirar_pagamento(payment_id):
+    """Chamado pela thread do webhook: entrega o id ao loop do bot e volta na hora."""
+    if _pagamentos_vistos.get(payment_id) is not None:
+        return False
+    with _pagamentos_lock:
+        if payment_id in _pagamentos_na_fila: return False
+        if _pagamentos_fila is None or _APP_LOOP is None or _APP_LOOP.is_closed():
+            raise RuntimeError("Bot ainda não está rodando")
+        _pagamentos_na_fila.add(payment_id)
+    _APP_LOOP.call_soon_threadsafe(_pagamentos_fila.put_nowait, payment_id)
+    return True
+
+async def avisar_pagamento(user_id, valor, saldo, avisar_usuario=True):
+    bot = _APP.bot
+    if avisar_usuario:
+        await envios.executar(user_id, lambda: bot.send_message(
+            chat_id=user_id,
+            text=f"✅ <b>Pagamento confirmado!</b>\n\n"
+                 f"💰 R$ {valor:.2f} adicionado ao seu saldo\n"
+                 f"🏦 Saldo atual: <b>R$ {saldo:.2f}</b>\n\n"
+                 f"Use /credito para resgatar seus prêmios!",
+            parse_mode="HTML"
+        ))
+    # Avisa admin também
+    if ADMIN_ID:
+        await envios.executar(ADMIN_ID, lambda: bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"💸 Pagamento recebido!\nUser: {user_id}\nValor: R$ {valor:.2f}",
+        ))
+
+async def processar_pagamento(payment_id, avisar_usuario=True):
+    """Consulta o MP e, se aprovado, credita (uma única vez) e avisa. Retorna (status, aplicado)."""
+    status = await asyncio.to_thread(verificar_pagamento_mp, payment_id)
+    aplicado = None
+    if status == "approved":
+        aplicado = await no_banco(aplicar_pagamento, payment_id)
+        if aplicado:
+            try:
+                await avisar_pagamento(*aplicado, avisar_usuario=avisar_usuario)
+            except Exception as e:
+                logging.warning(f"Aviso do pagamento {payment_id}: {e}")
+    if status in MP_STATUS_FINAIS:
+        _pagamentos_vistos.set(payment_id, status)
+    return status, aplicado
+
+async def _worker_pagamentos():
+    while True:
+        payment_id = await _pagamentos_fila.get()
+        try:
+            await processar_pagamento(payment_id)
+        except Exception as e:
+            logging.error(f"Pagamento {payment_id}: {e}")
+        finally:
+            with _pagamentos_lock: _pagamentos_na_fila.discard(payment_id)
+            _pagamentos_fila.task_done()
+
+def iniciar_pagamentos():
+    global _pagamentos_fila, _pagamentos_tarefas
+    with _pagamentos_lock:
+        _pagamentos_na_fila.clear()
+        _pagamentos_fila = asyncio.Queue()
+    _pagamentos_tarefas = [asyncio.create_task(_worker_pagamentos()) for _ in range(PAGAMENTOS_WORKERS)]
+
+async def parar_pagamentos():
+    global _pagamentos_fila
+    with _pagamentos_lock: _pagamentos_fila = None
+    for t in _pagamentos_tarefas: t.cancel()
+    await asyncio.gather(*_pagamentos_tarefas, return_exceptions=True)
+    _pagamentos_tarefas.clear()
+
+# Reconciliação: confere os PIX pendentes direto no MP, caso algum webhook se perca
+CONCILIAR_LOTE         = 200   # pendentes lidos do banco por vez
+CONCILIAR_CONCORRENCIA = 5     # consultas simultâneas ao MP
+CONCILIAR_CARENCIA_MIN = 3     # deixa os recém-criados para o webhook
+PIX_EXPIRA_H           = 48    # pendente há mais que isso (e ainda não pago) vira 'expired'
+
+_conciliacao = {"execucoes": 0, "verificados": 0, "aprovados": 0, "encerrados": 0,
+                "erros_mp": 0, "ultima_em": None, "ultima_duracao_s": None}
+_conciliando = False
+
+def pagamentos_pendentes(apos=None, limite=CONCILIAR_LOTE):
+    """Próximo lote de pendentes (paginação por (criado_em, payment_id)) com a idade em horas."""
+    with db() as cur:
+        cur.execute("""SELECT payment_id, criado_em, EXTRACT(EPOCH FROM NOW()-criado_em)/3600
+            FROM pagamentos
+            WHERE status='pending' AND criado_em < NOW() - %s * INTERVAL '1 minute'
+              AND (%s::timestamp IS NULL OR (criado_em, payment_id) > (%s::timestamp, %s))
+            ORDER BY criado_em, payment_id LIMIT %s""",
+            (CONCILIAR_CARENCIA_MIN, apos and apos[0], apos and apos[0], apos and apos[1], limite))
+        return cur.fetchall()
+
+async def conciliar_pagamentos():
+    """Varre os pendentes em lotes, consulta o MP com paralelismo limitado e aplica o resultado em massa."""
+    inicio = time.monotonic()
+    sem = asyncio.Semaphore(CONCILIAR_CONCORRENCIA)
+    totais = {"verificados": 0, "aprovados": 0, "encerrados": 0, "erros_mp": 0}
+
+    async def consultar(pid):
+        async with sem:
+            return await asyncio.to_thread(verificar_pagamento_mp, pid)
+
+    apos = None
+    while True:
+        lote = await no_banco(pagamentos_pendentes, apos)
+        if not lote: break
+        apos = (lote[-1][1], lote[-1][0])
+        status = await asyncio.gather(*(consultar(pid) for pid, _, _ in lote))
+        aprovados, finais = [], {}
+        for (pid, _, idade_h), st in zip(lote, status):
+            if st is None:
+                totais["erros_mp"] += 1
+            elif st == "approved":
+                aprovados.append(pid)
+            elif st in MP_STATUS_FINAIS:
+                finais[pid] = st
+            elif (st == "pending" or not isinstance(st, str)) and float(idade_h) > PIX_EXPIRA_H:
+                finais[pid] = "expired"   # PIX vencido, ou o MP não conhece mais o pagamento
+        totais["verificados"] += len(lote)
+        if aprovados:
+            creditados = await no_banco(aplicar_pagamentos, aprovados)
+            totais["aprovados"] += len(aprovados)
+            for aplicado in creditados:
+                try:
+                    await avisar_pagamento(*aplicado)
+                except Exception as e:
+                    logging.warning(f"Aviso de pagamento conciliado ({aplicado[0]}): {e}")
+        if finais:
+            totais["encerrados"] += await no_banco(encerrar_pagamentos, finais)
+        for pid in aprovados + list(finais):
+            _pagamentos_vistos.set(pid, finais.get(pid, "approved"))
+        if len(lote) < CONCILIAR_LOTE: break
+
+    duracao = round(time.monotonic() - inicio, 2)
+    for k, v in totais.items(): _conciliacao[k] += v
+    _conciliacao.update(execucoes=_conciliacao["execucoes"] + 1, ultima_duracao_s=duracao,
+                        ultima_em=datetime.utcnow().strftime("%d/%m/%Y %H:%M"))
+    if totais["verificados"]:
+        logging.info(f"Conciliação PIX: {totais['verificados']} verificados, {totais['aprovados']} aprovados, "
+                     f"{totais['encerrados']} encerrados, {totais['erros_mp']} sem resposta ({duracao}s)")
+    return totais
+
+@medir_job
+async def job_conciliar_pagamentos(context):
+    global _conciliando
+    if _conciliando or not MP_TOKEN: return
+    _conciliando = True
+    try:
+        await conciliar_pagamentos()
+    except Exception as e:
+        logging.error(f"job_conciliar_pagamentos: {e}")
+    finally:
+        _conciliando = False
+
+# ── Tarefas em segundo plano (painel) ─────────────────────────────────────
+TAREFAS_GUARDADAS = 50   # quantas tarefas concluídas ficam disponíveis no job_status
+
+_tarefas      = OrderedDict()   # id → progresso
+_tarefas_lock = threading.Lock()
+
+def status_tarefa(tid):
+    with _tarefas_lock:
+        t = _tarefas.get(tid)
+        if t is None: return None
+        t = dict(t)
+    feitos  = t["enviados"] + t["falhas"]
+    duracao = (t["fim"] or time.time()) - t["inicio"]
+    taxa    = feitos / duracao if duracao > 0 else 0.0
+    t.update(restantes=t["total"] - feitos, duracao_s=round(duracao, 1), por_segundo=round(taxa, 2),
+             eta_s=round((t["total"] - feitos) / taxa, 1) if taxa and t["status"] == "rodando" else None)
+    return t
+
+def listar_tarefas():
+    with _tarefas_lock: ids = list(_tarefas)
+    return [status_tarefa(tid) for tid in reversed(ids)]
+
+def _progresso(tid, **campos):
+    with _tarefas_lock:
+        t = _tarefas[tid]
+        for k, v in campos.items():
+            t[k] = t[k] + v if isinstance(v, int) else v
+
+async def _rodar_tarefa(tid, chats, entregar):
+    async def com_progresso(cid):
+        try:
+            await entregar(cid)
+        except Exception:
+            _progresso(tid, falhas=1); raise
+        _progresso(tid, enviados=1)
+    try:
+        await disparar(chats, com_progresso, rotulo=f"Tarefa {tid}")
+        _progresso(tid, status="concluida", fim=time.time())
+    except Exception as e:
+        logging.error(f"Tarefa {tid}: {e}")
+        _progresso(tid, status=f"erro: {e}", fim=time.time())
+
+def iniciar_tarefa(tipo, chats, entregar):
+    """Dispara `entregar(chat_id)` para os chats no loop do bot e retorna logo o id da tarefa."""
+    tid = secrets.token_hex(4)
+    with _tarefas_lock:
+        _tarefas[tid] = {"id": tid, "tipo": tipo, "status": "rodando", "total": len(chats),
+                         "enviados": 0, "falhas": 0, "inicio": time.time(), "fim": None}
+        while len(_tarefas) > TAREFAS_GUARDADAS:
+            antigo = next((k for k, v in _tarefas.items() if v["fim"]), None)
+            if antigo is None: break
+            del _tarefas[antigo]
+    try:
+        agendar_no_loop_do_bot(_rodar_tarefa(tid, chats, entregar))
+    except Exception as e:
+        _progresso(tid, status=f"erro: {e}", fim=time.time()); raise
+    return tid
+
+# ── Processamento de updates ───────────────────────────────────────────────
+UPDATES_CONCORRENTES = int(os.environ.get("UPDATES_CONCORRENTES", "32"))  # updates tratados ao mesmo tempo
+
+class ProcessadorPorChat(BaseUpdateProcessor):
+    """Chats diferentes em paralelo (até `max_concurrent_updates`); dentro de um chat, um update por vez e na ordem."""
+
+    def __init__(self, max_concurrent_updates):
+        # O semáforo do PTB é tomado antes do do_process_update: com ele no limite, updates
+        # esperando a trava do próprio chat ocupariam as vagas dos outros. O limite real é o nosso.
+        super().__init__(2 ** 30)
+        self._vagas  = asyncio.Semaphore(max_concurrent_updates)
+        self._travas = {}   # chat_id → [Lock, updates esperando ou rodando]
+
+    async def do_process_update(self, update, coroutine):
+        # Primeiro a trava do chat, depois a vaga global: a fila de um chat não segura vagas
+        chat = getattr(getattr(update, "effective_chat", None), "id", None)
+        if chat is None:
+            async with self._vagas:
+                await coroutine
+            return
+        trava = self._travas.setdefault(chat, [asyncio.Lock(), 0])
+        trava[1] += 1
+        try:
+            async with trava[0], self._vagas:
+                await coroutine
+        finally:
+            trava[1] -= 1
+            if not trava[1]: self._travas.pop(chat, None)
+
+    async def initialize(self): pass
+
+    async def shutdown(self): pass
+
 # ── Main ───────────────────────────────────────────────────────────────────
+_APP      = None   # Application em execução
+_APP_LOOP = None   # loop dela, para chamadas vindas da thread do servidor HTTP
+TELEGRAM_POOL = int(os.environ.get("TELEGRAM_POOL", "64"))  # conexões HTTP persistentes com a API do Telegram
+
+def agendar_no_loop_do_bot(coro):
+    """Agenda `coro` no loop do bot a partir de outra thread; retorna um concurrent Future."""
+    if _APP_LOOP is None or _APP_LOOP.is_closed():
+        coro.close(); raise RuntimeError("Bot ainda não está rodando")
+    return asyncio.run_coroutine_threadsafe(coro, _APP_LOOP)
+
+async def ao_iniciar(app):
+    global _APP, _APP_LOOP
+    _APP, _APP_LOOP = app, asyncio.get_running_loop()
+    iniciar_pagamentos()
+
+async def ao_encerrar(app):
+    """Libera os clientes HTTP persistentes quando a Application para."""
+    await parar_pagamentos()
+    await fechar_tmdb()
+    salvar_cache_tmdb()
+    flush_enviados()
+
+# ── Liderança (várias instâncias) ──────────────────────────────────────────
+# Com várias instâncias no mesmo banco, só uma roda os jobs agendados e a recuperação do
+# outbox: a que segura o advisory lock. O lock é de sessão, numa conexão fora do pool;
+# se o processo ou a conexão cair o Postgres solta e outra instância assume.
+LIDER_LOCK  = 0x43494E45   # chave do pg_try_advisory_lock disputada pelas instâncias
+_lider_conn = None
+_jobs_lider = []           # jobs registrados enquanto esta instância é a líder
+
+def tentar_lideranca():
+    """True se esta instância é (ou acabou de virar) a líder."""
+    global _lider_conn
+    if _lider_conn is not None:
+        try:
+            with _lider_conn.cursor() as cur: cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error as e:
+            logging.error(f"Liderança: conexão do lock caiu ({e})")
+            try: _lider_conn.close()
+            except Exception: pass
+            _lider_conn = None
+    r = urlparse(DATABASE_URL)
+    c = None
+    try:
+        c = psycopg2.connect(dbname=r.path[1:], user=r.username, password=r.password,
+                             host=r.hostname, port=r.port, connect_timeout=10,
+                             keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+        c.autocommit = True
+        with c.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (LIDER_LOCK,))
+            if cur.fetchone()[0]:
+                _lider_conn = c; return True
+    except psycopg2.Error as e:
+        logging.error(f"Liderança: {e}")
+    if c is not None: c.close()
+    return False
+
+def agendar_jobs_lider(jq):
+    """Jobs que não podem rodar em duas instâncias ao mesmo tempo (disparos, cobrança, limpeza)."""
+    _jobs_lider.extend([
+        jq.run_daily(job_diario_manha,           time=datetime.strptime("11:00","%H:%M").time()),  # 8h BRT
+        jq.run_daily(job_diario_noite,           time=datetime.strptime("23:00","%H:%M").time()),  # 20h BRT
+        jq.run_repeating(job_verificar_vencimentos, interval=3600, first=60),                       # a cada 1h
+        jq.run_repeating(job_outbox,                interval=300,  first=30),                        # retoma pendências
+        jq.run_repeating(job_conciliar_pagamentos,  interval=600,  first=120),                       # PIX sem webhook
+        jq.run_daily(job_limpeza, time=datetime.strptime("06:00","%H:%M").time()),   # 3h BRT
+        jq.run_daily(job_propaganda, time=datetime.strptime("13:00","%H:%M").time()),  # 10h BRT
+        jq.run_daily(job_propaganda, time=datetime.strptime("18:00","%H:%M").time()),  # 15h BRT
+        jq.run_daily(job_propaganda, time=datetime.strptime("22:00","%H:%M").time()),  # 19h BRT
+    ])
+
+async def job_lideranca(context: ContextTypes.DEFAULT_TYPE):
+    """A cada minuto: a líder confere o lock; as outras tentam assumir se ele ficou livre."""
+    lider = await asyncio.to_thread(tentar_lideranca)
+    if lider and not _jobs_lider:
+        logging.info("Liderança: esta instância assumiu os jobs agendados")
+        await no_banco(outbox_recuperar)
+        agendar_jobs_lider(context.job_queue)
+    elif not lider and _jobs_lider:
+        logging.warning("Liderança perdida: jobs agendados parados nesta instância")
+        for job in _jobs_lider: job.schedule_removal()
+        _jobs_lider.clear()
+
+async def rodar_webhook(app):
+    """Sobe a Application sem polling: o Telegram entrega os updates em TG_WEBHOOK_PATH,
+    servido pelo AdminHandler na mesma PORT. Para com SIGTERM/SIGINT.
+
+    O webhook não é removido ao parar (as outras instâncias continuam recebendo);
+    ao voltar para polling, o run_polling apaga o webhook registrado na subida."""
+    parar = asyncio.Event()
+    loop  = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try: loop.add_signal_handler(sig, parar.set)
+        except (NotImplementedError, RuntimeError): pass
+    await app.initialize()
+    try:
+        if app.post_init: await app.post_init(app)
+        await app.bot.set_webhook(url=f"{BOT_PUBLIC_URL}{TG_WEBHOOK_PATH}", secret_token=TG_WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        await app.start()
+        try:
+            await parar.wait()
+        finally:
+            await app.stop()
+    finally:
+        await app.shutdown()
+        if app.post_shutdown: await app.post_shutdown(app)
+
 def main():
     setup_db()
+    _jobs_lider.clear()   # jobs da Application anterior (reinício pelo laço do __main__)
+    lider = tentar_lideranca()
+    # 'sending' só é de um processo morto se quem olha é a líder: as outras podem estar enviando
+    if lider: outbox_recuperar()
+    else: logging.info("Liderança: outra instância roda os jobs agendados; esta só atende updates")
+    carregar_cache_tmdb()
     threading.Thread(target=start_health, daemon=True).start()
-    app = Application.builder().token(TOKEN).build()
+    # Um único Bot/pool HTTP atende handlers, jobs e as threads do painel/webhook
+    app = (Application.builder().token(TOKEN)
+           .connection_pool_size(TELEGRAM_POOL).pool_timeout(30)
+           .concurrent_updates(ProcessadorPorChat(UPDATES_CONCORRENTES))
+           .post_init(ao_iniciar).post_shutdown(ao_encerrar).build())
 
     # Comandos de cliente
     app.add_handler(CommandHandler("start",    cmd_start))
@@ -1782,15 +3104,19 @@ def main():
     # Jobs automáticos
     jq = app.job_queue
     if jq:
-        jq.run_daily(job_diario_manha,           time=datetime.strptime("11:00","%H:%M").time())  # 8h BRT
-        jq.run_daily(job_diario_noite,           time=datetime.strptime("23:00","%H:%M").time())  # 20h BRT
-        jq.run_repeating(job_verificar_vencimentos, interval=3600, first=60)                       # a cada 1h
-        jq.run_daily(job_propaganda, time=datetime.strptime("13:00","%H:%M").time())  # 10h BRT
-        jq.run_daily(job_propaganda, time=datetime.strptime("18:00","%H:%M").time())  # 15h BRT
-        jq.run_daily(job_propaganda, time=datetime.strptime("22:00","%H:%M").time())  # 19h BRT
-
-    logging.info(f"✅ Bot v8.0 SaaS Online — {SITE_URL}")
-    app.run_polling(drop_pending_updates=True)
+        # Estado local de cada instância: roda em todas
+        jq.run_repeating(job_flush_enviados,        interval=60,   first=60)                        # grava sent_items
+        if TMDB_CACHE_ARQUIVO:
+            jq.run_repeating(job_salvar_cache, interval=600, first=600)                             # a cada 10min
+        jq.run_repeating(job_lideranca,             interval=60,   first=60)                        # failover da líder
+        if lider: agendar_jobs_lider(jq)
+
+    if TG_WEBHOOK:
+        logging.info(f"✅ Bot v8.0 SaaS Online (webhook {TG_WEBHOOK_PATH}) — {SITE_URL}")
+        asyncio.run(rodar_webhook(app))
+    else:
+        logging.info(f"✅ Bot v8.0 SaaS Online — {SITE_URL}")
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     while True: